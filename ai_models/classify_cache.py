@@ -0,0 +1,110 @@
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+
+class ClassificationCache:
+    """
+    Two-tier cache for classification results.
+    Entries are keyed by a hash of the normalized text plus a hash of the prompt version, so
+    editing the prompt invalidates old results, and by the current date, since the prompt resolves
+    relative times against "now". Results whose tasks carry a When are never cached: "in an hour"
+    differs even within one day. A bounded in-process LRU sits in front of a
+    MongoDB collection whose TTL index (see core.db_indexes) expires stale entries.
+    """
+
+    def __init__(self, collection, prompt, max_entries=1024, ttl_seconds=86400):
+        self.collection = collection
+        self.prompt_version = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+        self.max_entries = max_entries
+        self.ttl = timedelta(seconds=ttl_seconds)
+
+        self._entries = OrderedDict()  # key -> (result, expires_at)
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+
+    @staticmethod
+    def normalize(text):
+        """Collapses whitespace and case so trivially different copies share one entry."""
+        return " ".join((text or "").split()).casefold()
+
+    def key(self, text):
+        digest = hashlib.sha256(self.normalize(text).encode("utf-8")).hexdigest()
+        return f"{self.prompt_version}:{datetime.now():%Y-%m-%d}:{digest}"
+
+    @staticmethod
+    def time_dependent(result):
+        """True when the result holds a task time the LLM resolved against the current time."""
+        tasks = result.get("Tasks") or []
+        return any(
+            isinstance(task, dict) and str(task.get("When") or "").strip().lower() not in ("", "null", "none")
+            for task in (tasks if isinstance(tasks, list) else [tasks])
+        )
+
+    # ---------------------------- Lookups
+    def get(self, text):
+        """Returns a cached classification for the text, or None on a miss."""
+        key = self.key(text)
+        now = datetime.now()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return copy.deepcopy(entry[0])
+            self._entries.pop(key, None)
+
+        try:
+            doc = self.collection.find_one({"_id": key, "created_at": {"$gt": now - self.ttl}})
+        except Exception as e:
+            print(f"Classification cache lookup failed: {e}")
+            doc = None
+
+        with self._lock:
+            if not doc:
+                self._stats["misses"] += 1
+                return None
+            self._stats["db_hits"] += 1
+            self._remember(key, doc["result"], doc["created_at"] + self.ttl)
+        return copy.deepcopy(doc["result"])
+
+    def put(self, text, result):
+        """Stores a valid classification in both tiers. Error responses and timed tasks are never cached."""
+        if not isinstance(result, dict) or "Category" not in result or "error" in result:
+            return
+        if self.time_dependent(result):
+            return
+
+        key = self.key(text)
+        now = datetime.now()
+        with self._lock:
+            self._remember(key, copy.deepcopy(result), now + self.ttl)
+
+        try:
+            self.collection.replace_one({"_id": key}, {"_id": key, "result": result, "created_at": now}, upsert=True)
+        except Exception as e:
+            print(f"Classification cache write failed: {e}")
+
+    def _remember(self, key, result, expires_at):
+        self._entries[key] = (result, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # ---------------------------- Sizing
+    def stats(self):
+        """Returns hit/miss counters and the in-process tier's occupancy."""
+        with self._lock:
+            lookups = sum(self._stats.values())
+            hits = self._stats["memory_hits"] + self._stats["db_hits"]
+            return {
+                **self._stats,
+                "lookups": lookups,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "prompt_version": self.prompt_version,
+            }
@@ -1,13 +1,20 @@
 import json
 import csv
+import time
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from setups import llm, llm_small
+from setups import llm, llm_small, classification_cache_collection, CLASSIFY_BATCH_SIZE, CLASSIFY_CONCURRENCY, \
+                   CLASSIFY_CACHE_SIZE, CLASSIFY_CACHE_TTL, SUMMARY_CHUNK_TOKENS, SUMMARY_CONCURRENCY
+from ai_models.classify_cache import ClassificationCache
+from ai_models.tokens import estimate_tokens, split_by_budget, truncate_to_budget
 # ---------------------------- Read AI Prompts
 PROMPT_PATHS = {
     "classification": "prompts/classification.txt",
+    "batch_classification": "prompts/batch_classification.txt",
     "daily_summary": "prompts/daily_summary.txt",
+    "summary_chunk": "prompts/summary_chunk.txt",
     "weekly_report": "prompts/weekly_report.txt",
 }
 
@@ -20,16 +27,33 @@ for key, path in PROMPT_PATHS.items():
     except FileNotFoundError:
         raise FileNotFoundError(f"Missing prompt file: {path}")
 
+def _compose_batch_prompt(single, wrapper):
+    """Fills the batch wrapper with the single-item format and guidelines, so both prompts share one copy."""
+    item_format, guidelines = single.split("\n", 1)[1].split("### Guidelines:", 1)
+    guidelines = "### Guidelines:" + guidelines.split("current_time:", 1)[0]
+    return wrapper.replace("{item_format}", item_format.strip()).replace("{guidelines}", guidelines.strip())
+
+PROMPTS["batch_classification"] = _compose_batch_prompt(PROMPTS["classification"], PROMPTS["batch_classification"])
+
 # ---------------------------- Initialize LLM once
 llm_classification = llm_small
 llm_summary = llm
+
+# ---------------------------- Classification cache
+classification_cache = ClassificationCache(
+    classification_cache_collection,
+    PROMPTS["classification"] + PROMPTS["batch_classification"],
+    max_entries=CLASSIFY_CACHE_SIZE,
+    ttl_seconds=CLASSIFY_CACHE_TTL,
+)
+
 # ---------------------------- AI Processing Functions
 def invoke_ai(llm, prompt_template, text, last_summary=None):
     """Helper function to send formatted prompt to LLM and return JSON response."""
     time_ = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     if prompt_template == PROMPTS["weekly_report"] and last_summary:
         prompt = prompt_template.replace("{text}", text).replace("{last_text}", last_summary)
-    elif prompt_template == PROMPTS["classification"]:
+    elif prompt_template in (PROMPTS["classification"], PROMPTS["batch_classification"]):
         prompt = prompt_template.replace("{text}", text).replace("{time_now}", time_)
     else:
         prompt = prompt_template.replace("{text}", text)
@@ -48,37 +72,186 @@ def invoke_ai(llm, prompt_template, text, last_summary=None):
 # ---- Classification into Categories
 def classify_text(text):
     """Classifies a message/email into categories, extract tasks, generate insights."""
+    cached = classification_cache.get(text)
+    if cached is not None:
+        return cached
+    return _classify_uncached(text)
+
+
+def _classify_uncached(text):
+    """Runs a single classification through the LLM and caches a valid result."""
     response = invoke_ai(llm_classification, PROMPTS["classification"], text)
+    classification_cache.put(text, response)
     return response
 
 
-# ---- Daily Summary Generation
-def generate_summary(csv_path):
-    # Read data from CSV
+def _classify_chunk(texts, indices, results):
+    """Classifies the texts at the given indices with a single prompt and stores them in results."""
+    if len(indices) == 1:
+        results[indices[0]] = _classify_uncached(texts[indices[0]])
+        return
+
+    items = json.dumps([{"id": str(i), "text": texts[i]} for i in indices], ensure_ascii=False)
+    response = invoke_ai(llm_classification, PROMPTS["batch_classification"], items)
+
+    returned = response.get("Results", []) if isinstance(response, dict) else []
+    by_id = {str(item.get("id")): item for item in returned if isinstance(item, dict)}
+
+    for i in indices:
+        item = by_id.get(str(i))
+        if item and "Category" in item:
+            results[i] = {key: value for key, value in item.items() if key != "id"}
+            classification_cache.put(texts[i], results[i])
+        else:
+            results[i] = _classify_uncached(texts[i])  # Fall back to a single call for items the batch missed
+
+
+def classify_batch(texts, batch_size=CLASSIFY_BATCH_SIZE, concurrency=CLASSIFY_CONCURRENCY):
+    """
+    Classifies several messages/emails by packing up to batch_size texts into one prompt.
+    Batches run concurrently (at most `concurrency` at a time). Cached texts skip the LLM.
+    Returns one result per text, in input order, shaped exactly like classify_text's output.
+    """
+    texts = list(texts)
+    results = [classification_cache.get(text) for text in texts]
+
+    # Only cache misses go to the LLM
+    pending = [i for i, result in enumerate(results) if result is None]
+    chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for future in [pool.submit(_classify_chunk, texts, chunk, results) for chunk in chunks]:
+            future.result()
+
+    return results
+
+
+# ---- Prompt serialization
+def load_records(source):
+    """
+    Returns the records to analyse as a list of dicts. `source` is either a CSV path (legacy export)
+    or an iterable of records streamed from MongoDB. Returns None when the CSV file is missing.
+    """
+    if not isinstance(source, (str, Path)):
+        return list(source)
+
     try:
-        with open(csv_path, "r", encoding="utf-8") as f:
+        with open(source, "r", encoding="utf-8") as f:
             reader = csv.reader(f)
             headers = next(reader, None)  # Extract headers
-            data = [dict(zip(headers, row)) for row in reader]  # Convert to list of dictionaries
+            return [dict(zip(headers, row)) for row in reader]  # Convert to list of dictionaries
     except FileNotFoundError:
-        return "Error: CSV file not found."
-    
-    # Convert data to JSON string before sending to LLM
-    csv_text = json.dumps(data, indent=2)
-    response = invoke_ai(llm_summary, PROMPTS["daily_summary"], csv_text)
-    
+        return None
+
+
+def compact_record(record):
+    """Serializes one record as minified JSON, dropping empty fields."""
+    return json.dumps({key: value for key, value in record.items() if value not in ("", None, [])},
+                      separators=(",", ":"), ensure_ascii=False)
+
+
+def compact_records(records):
+    """Serializes records for a prompt: one minified JSON object per line."""
+    return "\n".join(compact_record(record) for record in records)
+
+
+def _raw_text(response):
+    """Extracts the plain-text answer invoke_ai returns for non-JSON prompts."""
     if not response or "raw_response" not in response:
+        return None
+    return response.get("raw_response", "")
+
+
+def _condense(lines, chunk_tokens, concurrency):
+    """Map stage: condenses budgeted chunks of lines into notes, concurrently. Returns notes in order."""
+    chunks = split_by_budget(lines, chunk_tokens)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        responses = pool.map(lambda chunk: invoke_ai(llm_summary, PROMPTS["summary_chunk"], "\n".join(chunk)), chunks)
+        notes = [_raw_text(response) for response in responses]
+
+    if any(note is None for note in notes):
+        raise ValueError("Invalid response from AI while condensing a chunk.")
+    return notes
+
+
+def summarize_lines(lines, chunk_tokens=SUMMARY_CHUNK_TOKENS, concurrency=SUMMARY_CONCURRENCY):
+    """
+    Hierarchical (map-reduce) daily summary. Lines that fit the chunk budget go to the LLM in one call;
+    larger days are condensed chunk by chunk, and the notes are condensed again until they fit, before
+    the final reduce. Returns (raw summary text or None, per-stage timings).
+    """
+    started = time.perf_counter()
+    timings = {"lines": len(lines), "chunks": 0, "map_rounds": 0}
+
+    estimate_start = time.perf_counter()
+    lines = [truncate_to_budget(line, chunk_tokens) for line in lines]  # One oversized record can't blow the window
+    total_tokens = sum(estimate_tokens(line) for line in lines)
+    timings.update({"tokens": total_tokens, "estimate_s": time.perf_counter() - estimate_start})
+
+    map_start = time.perf_counter()
+    try:
+        while total_tokens > chunk_tokens and len(lines) > 1:
+            previous = len(lines)
+            lines = _condense(lines, chunk_tokens, concurrency)
+            timings["map_rounds"] += 1
+            timings["chunks"] += len(lines)
+            total_tokens = sum(estimate_tokens(line) for line in lines)
+            if len(lines) >= previous:
+                break  # Every line already fills a chunk on its own, condensing further won't help
+        if total_tokens > chunk_tokens:
+            raise ValueError(f"notes stopped shrinking at {total_tokens} tokens (budget {chunk_tokens})")
+    except ValueError as e:
+        print(f"Summary map stage failed: {e}")
+        return None, timings
+    timings["map_s"] = time.perf_counter() - map_start
+
+    reduce_start = time.perf_counter()
+    summary = _raw_text(invoke_ai(llm_summary, PROMPTS["daily_summary"], "\n".join(lines)))
+    timings["reduce_s"] = time.perf_counter() - reduce_start
+    timings["total_s"] = time.perf_counter() - started
+    return summary, timings
+
+
+# ---- Daily Summary Generation
+def _whatsapp_summary(lines):
+    """Runs the (map-reduce) summary over prompt lines and formats it for WhatsApp."""
+    raw_response, timings = summarize_lines(lines)
+    print("Daily summary timings:", {key: round(value, 3) if isinstance(value, float) else value
+                                     for key, value in timings.items()})
+
+    if raw_response is None:
         return "Error: Invalid response from AI."
-    raw_response = response.get("raw_response", "")
     formatted_response = raw_response.replace("\\n", "\n").replace("\\'", "'").replace('**', '*')
     return formatted_response
 
 
+def generate_summary(records):
+    """Generates the daily summary from streamed records (or a CSV path)."""
+    data = load_records(records)
+    if data is None:
+        return "Error: CSV file not found."
+    return _whatsapp_summary([compact_record(record) for record in data])
+
+
+def fold_into_notes(notes, lines, chunk_tokens=SUMMARY_CHUNK_TOKENS, concurrency=SUMMARY_CONCURRENCY):
+    """Folds new record lines into the running notes of the rolling digest. Returns None on an AI error."""
+    try:
+        return "\n".join(_condense(([notes] if notes else []) + lines, chunk_tokens, concurrency))
+    except ValueError as e:
+        print(f"Digest fold failed: {e}")
+        return None
+
+
+def finalize_summary(notes, lines):
+    """Turns the running digest notes plus the not-yet-folded lines into the final WhatsApp summary."""
+    return _whatsapp_summary(([notes] if notes else []) + lines)
+
+
 # ---- Weekly Report Generation
 from services.week_num import get_week_number
 
-def generate_report(csv_path, reference_day='Monday'):
-    """Generates weekly medical report from health data."""
+def generate_report(records, reference_day='Monday'):
+    """Generates weekly medical report from health data (streamed records or a CSV path)."""
     # Check if last week's data is available
     report_path = Path("reports")
     report_path.mkdir(exist_ok=True)
@@ -95,17 +268,11 @@ def generate_report(csv_path, reference_day='Monday'):
     if last_week_report.exists():
         prev_report = last_week_report.read_text(encoding="utf-8").strip()
 
-    try:
-        with open(csv_path, "r", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            headers = next(reader, None)  # Extract headers
-            data = [dict(zip(headers, row)) for row in reader]  # Convert to list of dictionaries
-    except FileNotFoundError:
+    data = load_records(records)
+    if data is None:
         return "Error: CSV file not found."
 
-    # Convert data to JSON string before sending to LLM
-    csv_text = json.dumps(data, indent=2)
-    response = invoke_ai(llm_summary, PROMPTS["weekly_report"], csv_text, last_summary=prev_report)
+    response = invoke_ai(llm_summary, PROMPTS["weekly_report"], compact_records(data), last_summary=prev_report)
     
     if not response or "raw_response" not in response:
         return "Error: Invalid response from AI."
@@ -0,0 +1,54 @@
+from functools import lru_cache
+
+# ---------------------------- Token estimation
+@lru_cache(maxsize=1)
+def _encoding():
+    """Loads the tokenizer once. Falls back to a character heuristic if tiktoken is unavailable."""
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model("gpt-4-turbo")
+    except Exception as e:
+        print(f"tiktoken unavailable, estimating tokens from length: {e}")
+        return None
+
+
+def estimate_tokens(text):
+    """Returns the (approximate) number of tokens the text costs in a prompt."""
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+TRUNCATED = " [truncated]"
+
+
+def truncate_to_budget(text, budget):
+    """Cuts text down to at most `budget` estimated tokens, marking the cut. Text within budget is returned as is."""
+    if estimate_tokens(text) <= budget:
+        return text
+    keep = max(budget - estimate_tokens(TRUNCATED), 0)
+    encoding = _encoding()
+    if encoding is None:
+        return text[:keep * 4] + TRUNCATED
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:keep]) + TRUNCATED
+
+
+def split_by_budget(items, budget):
+    """
+    Groups text items into consecutive chunks whose estimated token count stays within budget.
+    An item larger than the whole budget is truncated to fit a chunk on its own.
+    """
+    chunks, current, size = [], [], 0
+    for item in items:
+        item = truncate_to_budget(item, budget)
+        tokens = estimate_tokens(item)
+        if current and size + tokens > budget:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(item)
+        size += tokens
+
+    if current:
+        chunks.append(current)
+    return chunks
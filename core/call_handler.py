@@ -1,114 +1,219 @@
+import re
+import asyncio
 from setups import llm, llm_small, openai_client, task_collection
 from datetime import datetime
 # ---------------------------- Main AI Function
-conv_hist = {}  # Store conversation history
-
 with open(r"prompts/outgoing_call.txt", 'r') as f:
     OUTBOUND_PROMPT = f.read().strip()
 
 with open(r"prompts/incoming_call.txt", 'r') as f:
     INBOUND_PROMPT = f.read().strip()
 
-def ai_model(text, context, history, appt=None, call_type=None):
-    """Generates AI Responses using OpenAI while maintaining conversation history."""
+FALLBACK_REPLY = "I'm sorry, I couldn't process that. Could you please repeat?"
+SENTENCE_END = re.compile(r"[.!?][\"')\]]*\s+")  # Sentence punctuation (and closing quotes) followed by whitespace
+MIN_SENTENCE_CHARS = 20  # Shorter fragments ("Sure.") are merged into the next sentence
+
+def _build_prompt(text, context, history, appt=None, call_type=None):
     prompt_template = OUTBOUND_PROMPT if call_type else INBOUND_PROMPT
     time_ = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    prompt = f"""{prompt_template}\n\n
+    return f"""{prompt_template}\n\n
         Current Time: {time_}\n\n
         Call Type: {call_type or "N/A"}\n\n
         Context from past conversations: {context}\n\n
         Conversation history till this point: {history}\n\n
         Appointment Availability: {appt}\n\n
         New Input: {text}"""
-    
+
+async def ai_model(text, context, history, appt=None, call_type=None):
+    """Streams the AI response token by token while maintaining conversation history."""
+    prompt = _build_prompt(text, context, history, appt, call_type)
     try:
-        response = llm.invoke(prompt)
-        return response.content
+        async for chunk in llm.astream(prompt):
+            if chunk.content:
+                yield chunk.content
     except Exception as e:
         print(f"Error calling OpenAI API: {e}")
-        return "I'm sorry, I couldn't process that. Could you please repeat?"
+        yield FALLBACK_REPLY
+
+async def split_sentences(tokens):
+    """Regroups a token stream into sentences so each one can go to TTS as soon as it is complete."""
+    buffer = ""
+    async for token in tokens:
+        buffer += token
+        while True:
+            match = next((m for m in SENTENCE_END.finditer(buffer) if m.end() > MIN_SENTENCE_CHARS), None)
+            if not match:
+                break
+            yield buffer[:match.end()].strip()
+            buffer = buffer[match.end():]
+    if buffer.strip():
+        yield buffer.strip()
 
 # ---------------------------- Handling calls
-from services.call import check_intent, extract_details, tts_engine, extract_time, generate_call_summary
+from services.call import check_intent, extract_details, extract_time, generate_call_summary
 from core.event_scheduler import check_availability, create_event, fetch_events, delete_event
 from core.store_data_db import store_call_summary
+from core.call_sessions import sessions
 from services.task_creater import create_task
 
-async def call(call_id, number, start_time, context, user_input=None, call_type=None):
-    """Handles incoming and outgoing calls, processes user input, and executes intent-based actions."""
-    # Fetch conversation history
-    history = conv_hist.setdefault(call_id, []) 
-    if user_input:
-        history.append({"role": "user", "content": user_input})
-        conv_hist[call_id] = history
+APPOINTMENT_INTENTS = ("schedule_appt", "reschedule_appt", "cancel_appt")
+
+def prefetch(tokens):
+    """Starts consuming an async iterator in the background. Returns (task, iterator replaying its items)."""
+    queue = asyncio.Queue()
+    end = object()
+
+    async def pump():
+        try:
+            async for item in tokens:
+                queue.put_nowait(item)
+        finally:
+            queue.put_nowait(end)
+
+    task = asyncio.create_task(pump())
+
+    async def replay():
+        try:
+            while (item := await queue.get()) is not end:
+                yield item
+        finally:
+            task.cancel()  # No-op once finished; stops generation if the consumer is cancelled
+
+    return task, replay()
+
+async def _apply_appointment(intent, task_details, identifier, extracted_time, event_details):
+    """The calendar/Mongo writes of an appointment intent (task_details is None when details are missing)."""
+    appt_status = None
+    if intent in ["schedule_appt", "reschedule_appt"]:
+        if task_details is None:
+            appt_status = "details missing"
+        elif extracted_time and await asyncio.to_thread(check_availability, extracted_time):
+            task_data = create_task(task_details, identifier)
+            await asyncio.gather(
+                asyncio.to_thread(task_collection.insert_one, task_data),
+                asyncio.to_thread(create_event, task_data),
+            )
+            appt_status = "rescheduled" if intent == "reschedule_appt" else "available"
+        else:
+            appt_status = "unavailable"
 
-    # Determine intent
-    intent = check_intent(conv_hist, call_id, llm_small)
-    intent = 'none' if not intent['intent'] else intent['intent']
+        # Cancel previous appointment if rescheduling
+        if intent == "reschedule_appt" and event_details:
+            await asyncio.gather(
+                asyncio.to_thread(delete_event, event_id=event_details["event_id"]),
+                asyncio.to_thread(
+                    task_collection.update_one, {"task_id": event_details["task_id"]}, {"$set": {"status": "cancelled"}}
+                ),
+            )
 
-    appt_status = None  # Appointment status for response generation
+    elif intent == "cancel_appt":
+        if event_details and await asyncio.to_thread(delete_event, event_id=event_details["event_id"]):
+            await asyncio.to_thread(
+                task_collection.update_one, {"task_id": event_details["task_id"]}, {"$set": {"status": "cancelled"}}
+            )
+            appt_status = "cancelled"
+        else:
+            appt_status = "appt not found"
+
+    return appt_status
+
+async def handle_appointment(intent, session):
+    """
+    Runs the calendar side of an appointment intent. Blocking Calendar/Mongo calls go to the executor.
+    Lookups and extraction may be abandoned by a barge-in; the writes are shielded and always run to the
+    end, so a reschedule can't create the new event and leave the old one behind.
+    """
+    task_details, identifier, extracted_time = None, None, None
     if intent in ["schedule_appt", "reschedule_appt"]:
         task_details = {
             "what": None, "when": None, "how": None, "where": None, "with_whom": None, "status": "pending"
         }
         identifier = {
             "source": "call",
-            "call_id": call_id,
-            "timestamp": datetime.fromisoformat(start_time).strftime("%Y-%m-%d %H:%M:%S"),
+            "call_id": session.call_id,
+            "timestamp": datetime.fromisoformat(session.start_time).strftime("%Y-%m-%d %H:%M:%S"),
         }
 
-        event_details = fetch_events(number) if intent == "reschedule_appt" else None
-        extracted_details = extract_details(conv_hist, call_id, llm_small, event_details)
+        event_details = await asyncio.to_thread(fetch_events, session.number) if intent == "reschedule_appt" else None
+        extracted_details = await extract_details(session.transcript(), llm_small, event_details)
         print("Extracted details:", extracted_details)
-        task_details.update(extracted_details)
+        task_details.update(extracted_details or {})
         print("Task Details:", task_details)
 
         if not task_details["when"] or not task_details["when"].strip() or not task_details["what"] or not task_details["what"].strip():
-            appt_status = "details missing"
-        elif task_details["when"]:
-            extracted_time = extract_time(task_details["when"])
-            if extracted_time and check_availability(extracted_time):
-                task_data = create_task(task_details, identifier)
-                task_collection.insert_one(task_data)
-                create_event(task_data)
-                appt_status = "rescheduled" if intent == "reschedule_appt" else "available"
-            else:
-                appt_status = "unavailable"
-
-        # Cancel previous appointment if rescheduling
-        if intent == "reschedule_appt" and event_details:
-            delete_event(event_id=event_details["event_id"])
-            task_collection.update_one(
-                {"task_id": event_details["task_id"]}, {"$set": {"status": "cancelled"}}
-            )
+            task_details = None  # Details missing
+        else:
+            extracted_time = await asyncio.to_thread(extract_time, task_details["when"])
 
     elif intent == "cancel_appt":
-        event_details = fetch_events(number)
-        if event_details and delete_event(event_id=event_details["event_id"]):
-            task_collection.update_one(
-                {"task_id": event_details["task_id"]}, {"$set": {"status": "cancelled"}}
-            )
-            appt_status = "cancelled"
-        else:
-            appt_status = "appt not found"
-            
-    
+        event_details = await asyncio.to_thread(fetch_events, session.number)
+
+    writes = asyncio.create_task(_apply_appointment(intent, task_details, identifier, extracted_time, event_details))
+    try:
+        return await asyncio.shield(writes)
+    except asyncio.CancelledError:
+        await asyncio.wait([writes])  # Barge-in: let the writes finish together before the turn stops
+        raise
+
+async def call(session, user_input=None, speaker=None):
+    """
+    Handles incoming and outgoing calls, processes user input, and executes intent-based actions.
+    Returns an async iterator of TTS audio chunks, synthesized on the call's `speaker` (SpeechStream).
+
+    Intent detection and a speculative reply (written as if no appointment action is needed) start
+    together. The speculative reply is used unless the intent turns out to need the calendar.
+    """
+    if user_input:
+        await asyncio.to_thread(sessions.add_turn, session, "user", user_input)  # Mongo store: keep the loop free
+    history = session.transcript()
+
+    # Determine intent while the reply is already being generated
+    speculative, speculative_tokens = prefetch(ai_model(user_input, session.context, history, None, session.call_type))
+    try:
+        intent = await check_intent(history, llm_small)
+    except BaseException:
+        speculative.cancel()
+        raise
+    intent = (intent or {}).get('intent') or 'none'
+
+    if intent not in APPOINTMENT_INTENTS:
+        return _respond(session, speculative_tokens, speaker)
+
+    speculative.cancel()  # The reply has to reflect the appointment outcome
+    appt_status = await handle_appointment(intent, session)
     print("Appointment Status:",appt_status)
-    # Generate AI response
-    ai_response = ai_model(user_input, context, history, appt_status, call_type)
-    history.append({"role": "assistant", "content": ai_response})
-    conv_hist[call_id] = history
-    print(ai_response)
-    
+    tokens = ai_model(user_input, session.context, history, appt_status, session.call_type)
+    return _respond(session, tokens, speaker)
+
+async def _respond(session, tokens, speaker):
+    """Streams the AI response through TTS, yielding audio while later sentences are still being generated."""
+    spoken = []
+
+    async def sentences():
+        async for sentence in split_sentences(tokens):
+            spoken.append(sentence)
+            yield sentence
+
     # Generate TTS output
-    audio_output = await tts_engine(ai_response)
+    try:
+        async for chunk in speaker.speak(sentences()):
+            yield chunk
+    except asyncio.CancelledError:
+        # Barge-in: keep what was already said so the next turn knows where the caller cut in
+        if spoken:
+            interrupted = " ".join(spoken) + " [interrupted by caller]"
+            await asyncio.to_thread(sessions.add_turn, session, "assistant", interrupted)
+        raise
+
+    ai_response = " ".join(spoken)
+    await asyncio.to_thread(sessions.add_turn, session, "assistant", ai_response)
+    print(ai_response)
 
     # Handling call summary generation at the end of the call
     if any(phrase in ai_response.lower() for phrase in ["goodbye", "have a nice day", "bye"]):
-        conversation = "\n".join([f"{entry['role']}: {entry['content']}" for entry in conv_hist.get(call_id, [])])
-        call_ = "Outbound" if call_type else "Inbound"
-        call_summary = generate_call_summary(conversation, call_id, number, call_, start_time, llm_small)
-        store_call_summary(call_summary)
-
-    return audio_output
+        call_ = "Outbound" if session.call_type else "Inbound"
+        call_summary = await generate_call_summary(
+            session.transcript(), session.call_id, session.number, call_, session.start_time, llm_small
+        )
+        await asyncio.to_thread(store_call_summary, call_summary)
@@ -0,0 +1,152 @@
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, deque
+from pymongo import ReturnDocument
+
+from setups import call_session_collection, CALL_SESSION_BACKEND, CALL_SESSION_TTL, CALL_HISTORY_MAX
+
+
+class Turn:
+    """One line of a call's conversation."""
+
+    __slots__ = ("role", "content", "at")
+
+    def __init__(self, role, content, at=None):
+        self.role = role
+        self.content = content
+        self.at = at or time.time()
+
+    def as_dict(self):
+        return {"role": self.role, "content": self.content, "at": self.at}
+
+
+class CallSession:
+    """Everything kept about a live call: who, what kind, the caller's context and the last turns."""
+
+    __slots__ = ("call_id", "number", "call_type", "start_time", "context", "history", "expires_at")
+
+    def __init__(self, call_id, number="", call_type=None, start_time="", context="", history=(), expires_at=0):
+        self.call_id = call_id
+        self.number = number
+        self.call_type = call_type
+        self.start_time = start_time
+        self.context = context
+        self.history = deque(history, maxlen=CALL_HISTORY_MAX)  # Oldest turns fall off
+        self.expires_at = expires_at
+
+    def transcript(self):
+        return "\n".join(f"{turn.role}: {turn.content}" for turn in self.history)
+
+    @classmethod
+    def from_dict(cls, doc):
+        history = [Turn(turn["role"], turn["content"], turn.get("at")) for turn in doc.get("history", [])]
+        expires_at = doc["expires_at"].replace(tzinfo=timezone.utc).timestamp() if doc.get("expires_at") else 0
+        return cls(doc["call_id"], doc.get("number", ""), doc.get("call_type"), doc.get("start_time", ""),
+                   doc.get("context", ""), history, expires_at)
+
+
+class MemorySessionStore:
+    """
+    Call sessions for this process. A session lives until the media stream stops (`end`) or, if that
+    never arrives, until it has been idle for `ttl` seconds; expired sessions are swept on access.
+    """
+
+    def __init__(self, ttl=CALL_SESSION_TTL):
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # Least recently touched first
+        self._lock = threading.Lock()   # /voice runs on Flask threads, the media stream on its own loop
+
+    def _sweep(self, now):
+        while self._sessions:
+            call_id, session = next(iter(self._sessions.items()))
+            if session.expires_at > now:
+                break
+            del self._sessions[call_id]
+
+    def _touch(self, session, now):
+        session.expires_at = now + self.ttl
+        self._sessions[session.call_id] = session
+        self._sessions.move_to_end(session.call_id)
+
+    def open(self, call_id, **fields):
+        """Returns the call's session, creating it with `fields` if it doesn't exist yet."""
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            session = self._sessions.get(call_id) or CallSession(call_id, **fields)
+            self._touch(session, now)
+            return session
+
+    def get(self, call_id):
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            session = self._sessions.get(call_id)
+            if session:
+                self._touch(session, now)
+            return session
+
+    def add_turn(self, session, role, content):
+        turn = Turn(role, content)
+        session.history.append(turn)
+        with self._lock:
+            self._touch(session, time.time())
+        return turn
+
+    def end(self, call_id):
+        with self._lock:
+            self._sessions.pop(call_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class MongoSessionStore:
+    """
+    Shares sessions across worker processes through MongoDB, so /voice and the media stream may land on
+    different workers. History is appended with `$push`/`$slice`, and a TTL index on `expires_at`
+    removes sessions whose call never sent "stop".
+    """
+
+    def __init__(self, collection, ttl=CALL_SESSION_TTL):
+        self.collection = collection
+        self.ttl = ttl
+
+    def _expiry(self):
+        return datetime.now(timezone.utc) + timedelta(seconds=self.ttl)  # TTL indexes compare in UTC
+
+    def open(self, call_id, **fields):
+        doc = self.collection.find_one_and_update(
+            {"call_id": call_id},
+            {"$setOnInsert": {"call_id": call_id, "history": [], **fields}, "$set": {"expires_at": self._expiry()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return CallSession.from_dict(doc)
+
+    def get(self, call_id):
+        doc = self.collection.find_one_and_update(
+            {"call_id": call_id}, {"$set": {"expires_at": self._expiry()}}, return_document=ReturnDocument.AFTER
+        )
+        return CallSession.from_dict(doc) if doc else None
+
+    def add_turn(self, session, role, content):
+        turn = Turn(role, content)
+        session.history.append(turn)
+        self.collection.update_one(
+            {"call_id": session.call_id},
+            {
+                "$push": {"history": {"$each": [turn.as_dict()], "$slice": -CALL_HISTORY_MAX}},
+                "$set": {"expires_at": self._expiry()},
+            },
+        )
+        return turn
+
+    def end(self, call_id):
+        self.collection.delete_one({"call_id": call_id})
+
+
+sessions = (
+    MongoSessionStore(call_session_collection) if CALL_SESSION_BACKEND == "mongo" else MemorySessionStore()
+)
@@ -0,0 +1,187 @@
+import time
+import threading
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from ai_models.model import compact_record, fold_into_notes, finalize_summary
+from setups import daily_digest_collection, digest_item_collection, DIGEST_FOLD_EVERY
+
+# ---------------------------- Rolling daily digest
+# One small document per day, updated as items are processed:
+#   counts          -> items per category
+#   item_count      -> items recorded today
+#   folded          -> how many of them are already folded into partial_summary
+#   partial_summary -> running LLM notes covering the folded items
+#   fold_lease      -> while set and in the future, one worker holds the right to fold
+# The items themselves go to digest_item_collection, one document each (date, source_key, line, tasks,
+# insights, folded), so a busy day never grows one document and a fold only reads the unfolded ones.
+
+FOLD_DEBOUNCE = 10   # Seconds a requested fold waits, so items arriving together fold together
+FOLD_LEASE = 600     # Seconds a fold claim is honoured before a crashed folder's claim is taken over
+
+_fold_requests = set()
+_fold_wakeup = threading.Event()
+_folder = None
+_folder_lock = threading.Lock()
+
+def _digest_record(ai_response, data, source):
+    """The compact prompt line for one processed message/email (same fields as the daily export)."""
+    tasks = ai_response.get("Tasks") if isinstance(ai_response.get("Tasks"), list) else []
+    insights = ai_response.get("Actionable_Insights") if isinstance(ai_response.get("Actionable_Insights"), list) else []
+    return compact_record({
+        "Source": "WhatsApp" if source == "whatsapp" else "Email",
+        "Sender": data.get("sender", "Unknown"),
+        "Timestamp": data.get("timestamp") or data.get("received_time", ""),
+        "Message": data.get("message") or data.get("body", ""),
+        "Category": ai_response.get("Category", ""),
+        "Tasks": " | ".join(task.get("What") or "" for task in tasks),
+        "Task Due Date": " | ".join(task.get("When") or "" for task in tasks),
+        "Task Priority": ai_response.get("Priority", "") if tasks else "",
+        "Insights": ", ".join(str(insight) for insight in insights if insight),
+    })
+
+
+def record_item(ai_response, data, source):
+    """Adds a processed message/email to today's digest (once per source id) and folds when enough piled up."""
+    date = time.strftime("%Y-%m-%d")
+    source_id = data.get("message_id") if source == "whatsapp" else data.get("email_id")
+    source_key = f"{source}:{source_id}" if source_id else None
+    category = str(ai_response.get("Category", "unknown")).lower().replace(".", "_").replace("$", "_")
+
+    tasks = ai_response.get("Tasks") if isinstance(ai_response.get("Tasks"), list) else []
+    insights = ai_response.get("Actionable_Insights") if isinstance(ai_response.get("Actionable_Insights"), list) else []
+
+    item = {
+        "date": date,
+        "line": _digest_record(ai_response, data, source),
+        "tasks": [{"what": task.get("What"), "when": task.get("When"), "status": "pending"} for task in tasks],
+        "insights": [insight for insight in insights if insight],
+        "folded": False,
+        "recorded_at": datetime.now(),
+    }
+    if source_key:
+        item["source_key"] = source_key
+    try:
+        digest_item_collection.insert_one(item)
+    except DuplicateKeyError:
+        return  # Redelivered item, already recorded
+
+    update = {
+        "$inc": {f"counts.{category}": 1, "item_count": 1},
+        "$set": {"updated_at": datetime.now()},
+        "$setOnInsert": {"folded": 0, "partial_summary": ""},
+    }
+    try:
+        digest = daily_digest_collection.find_one_and_update(
+            {"date": date}, update, upsert=True,
+            projection={"folded": 1, "item_count": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Another worker created today's digest first
+        digest = daily_digest_collection.find_one_and_update(
+            {"date": date}, update,
+            projection={"folded": 1, "item_count": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    if digest["item_count"] - digest["folded"] >= DIGEST_FOLD_EVERY:
+        request_fold(date)
+
+
+def _unfolded(date):
+    """The items of the day not yet folded into the notes, in arrival order."""
+    return list(digest_item_collection.find({"date": date, "folded": False}, {"line": 1}).sort("_id", 1))
+
+
+def request_fold(date):
+    """Asks the background folder to fold the day soon. Ingestion never waits on the LLM."""
+    global _folder
+    with _folder_lock:
+        _fold_requests.add(date)
+        _fold_wakeup.set()
+        if _folder is None:
+            _folder = threading.Thread(target=_fold_loop, name="digest-folder", daemon=True)
+            _folder.start()
+
+
+def _fold_loop():
+    while True:
+        _fold_wakeup.wait()
+        time.sleep(FOLD_DEBOUNCE)
+        with _folder_lock:
+            dates = sorted(_fold_requests)
+            _fold_requests.clear()
+            _fold_wakeup.clear()
+
+        for date in dates:
+            try:
+                fold_digest(date)
+            except Exception as e:
+                print(f"Digest fold for {date} failed: {e}")
+
+
+def fold_digest(date):
+    """
+    Folds items added since the last fold into the partial summary. Returns the up-to-date notes.
+    The fold is claimed atomically, so while one worker runs the LLM the others serve the current notes.
+    """
+    now = datetime.now()
+    lease = now.replace(microsecond=now.microsecond // 1000 * 1000) + timedelta(seconds=FOLD_LEASE)  # BSON keeps ms
+    digest = daily_digest_collection.find_one_and_update(
+        {"date": date, "$or": [{"fold_lease": {"$exists": False}}, {"fold_lease": {"$lt": now}}]},
+        {"$set": {"fold_lease": lease}},
+        projection={"partial_summary": 1},
+    )
+    if not digest:
+        current = daily_digest_collection.find_one({"date": date}, {"partial_summary": 1})
+        return current.get("partial_summary", "") if current else None
+
+    try:
+        pending = _unfolded(date)
+        if not pending:
+            return digest.get("partial_summary", "")
+
+        notes = fold_into_notes(digest.get("partial_summary", ""), [item["line"] for item in pending])
+        if notes is None:
+            return digest.get("partial_summary", "")
+
+        # Only while the lease is still ours: a worker that outlived it must not overwrite the new holder's notes
+        result = daily_digest_collection.update_one(
+            {"date": date, "fold_lease": lease},
+            {"$set": {"partial_summary": notes}, "$inc": {"folded": len(pending)}},
+        )
+        if not result.matched_count:
+            return notes
+        digest_item_collection.update_many({"_id": {"$in": [item["_id"] for item in pending]}},
+                                           {"$set": {"folded": True}})
+        return notes
+    finally:
+        daily_digest_collection.update_one({"date": date, "fold_lease": lease}, {"$unset": {"fold_lease": ""}})
+
+
+def summary_so_far(date):
+    """Counts, open tasks, insights and the running notes for the day, folding any pending items first."""
+    notes = fold_digest(date)
+    digest = daily_digest_collection.find_one({"date": date}, {"_id": 0, "date": 1, "counts": 1, "item_count": 1})
+    if not digest:
+        return None
+
+    open_tasks, insights = [], []
+    for item in digest_item_collection.find({"date": date}, {"tasks": 1, "insights": 1}).sort("_id", 1):
+        open_tasks += item.get("tasks", [])
+        insights += item.get("insights", [])
+    return {**digest, "open_tasks": open_tasks, "insights": insights, "summary": notes}
+
+
+def finalize_digest(date):
+    """
+    Produces the end-of-day WhatsApp summary from the running notes plus the small unfolded delta.
+    Returns None when no digest exists for the day (the caller falls back to the full summary).
+    """
+    digest = daily_digest_collection.find_one({"date": date}, {"partial_summary": 1})
+    if not digest:
+        return None
+    return finalize_summary(digest.get("partial_summary", ""), [item["line"] for item in _unfolded(date)])
@@ -0,0 +1,149 @@
+import sys
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+from setups import health_collection, message_collection, email_collection, \
+                   task_collection, insight_collection, call_collection, \
+                   daily_sum_collection, weekly_report_collection, \
+                   ingest_queue_collection, classification_cache_collection, \
+                   daily_digest_collection, digest_item_collection, mail_sync_collection, \
+                   call_session_collection, CLASSIFY_CACHE_TTL
+
+FINISHED_JOB_TTL = 7 * 86400  # Seconds finished ingestion jobs are kept for inspection
+
+
+def _unique(field):
+    """Unique index that ignores documents missing the field."""
+    return [(field, ASCENDING)], {"unique": True, "partialFilterExpression": {field: {"$exists": True}}}
+
+
+# ---------------------------- Index definitions
+INDEXES = [
+    (message_collection, [
+        _unique("message_id"),
+        ([("sender", ASCENDING), ("timestamp", ASCENDING)], {}),  # get_context
+        ([("timestamp", ASCENDING)], {}),                         # daily summary
+    ]),
+    (email_collection, [
+        _unique("email_id"),
+        ([("received_time", ASCENDING)], {}),                     # daily summary
+    ]),
+    (task_collection, [
+        _unique("dedup_key"),
+        ([("message_id", ASCENDING)], {}),
+        ([("email_id", ASCENDING)], {}),
+        ([("task_id", ASCENDING)], {}),
+    ]),
+    (insight_collection, [
+        _unique("dedup_key"),
+        ([("message_id", ASCENDING)], {}),
+        ([("email_id", ASCENDING)], {}),
+    ]),
+    (health_collection, [
+        ([("timestamp", ASCENDING)], {"unique": True}),
+    ]),
+    (call_collection, [
+        ([("call_id", ASCENDING)], {}),
+    ]),
+    (daily_sum_collection, [
+        ([("date", ASCENDING)], {}),
+    ]),
+    (weekly_report_collection, [
+        ([("week", ASCENDING)], {}),
+    ]),
+    (daily_digest_collection, [
+        ([("date", ASCENDING)], {"unique": True}),
+    ]),
+    (digest_item_collection, [
+        ([("date", ASCENDING), ("source_key", ASCENDING)],
+         {"unique": True, "partialFilterExpression": {"source_key": {"$exists": True}}}),  # Redelivered items
+        ([("date", ASCENDING), ("folded", ASCENDING)], {}),                                # Unfolded delta
+    ]),
+    (mail_sync_collection, [
+        ([("mailbox", ASCENDING)], {"unique": True}),
+    ]),
+    (ingest_queue_collection, [
+        ([("source", ASCENDING), ("job_id", ASCENDING)], {"unique": True}),
+        ([("status", ASCENDING), ("next_attempt_at", ASCENDING)], {}),
+        ([("finished_at", ASCENDING)], {"expireAfterSeconds": FINISHED_JOB_TTL}),
+    ]),
+    (classification_cache_collection, [
+        ([("created_at", ASCENDING)], {"expireAfterSeconds": CLASSIFY_CACHE_TTL}),
+    ]),
+    (call_session_collection, [
+        ([("call_id", ASCENDING)], {"unique": True}),
+        ([("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),  # Sessions whose call never sent "stop"
+    ]),
+]
+
+
+def ensure_indexes():
+    """Creates every index in INDEXES. Safe to run on each startup: existing indexes are left untouched."""
+    failed = []
+    for collection, indexes in INDEXES:
+        for keys, options in indexes:
+            try:
+                collection.create_index(keys, **options)
+            except OperationFailure as e:
+                # Usually duplicate data blocking a unique index, or an index with the same keys but other options
+                print(f"Could not create index {keys} on {collection.name}: {e}")
+                failed.append((collection.name, keys))
+    return failed
+
+
+# ---------------------------- Query plan validation
+def _hot_queries():
+    """Representative filters for the queries on the hot paths."""
+    today = datetime.now().strftime("%Y-%m-%d")
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+    last_week = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S")
+
+    return [
+        ("message by id", message_collection, {"message_id": "SM0"}),
+        ("caller context", message_collection, {"sender": "whatsapp:+0", "timestamp": {"$gte": last_week}}),
+        ("messages of the day", message_collection, {"timestamp": {"$gte": today, "$lt": tomorrow}}),
+        ("email by id", email_collection, {"email_id": "0"}),
+        ("emails of the day", email_collection, {"received_time": {"$gte": today, "$lt": tomorrow}}),
+        ("tasks of a source", task_collection, {"$or": [{"message_id": "SM0"}, {"email_id": "0"}]}),
+        ("task by id", task_collection, {"task_id": "0"}),
+        ("insights of a source", insight_collection, {"$or": [{"message_id": "SM0"}, {"email_id": "0"}]}),
+        ("health of the day", health_collection, {"timestamp": today}),
+        ("health of the week", health_collection, {"timestamp": {"$gte": last_week[:10], "$lte": today}}),
+        ("unfolded digest items", digest_item_collection, {"date": today, "folded": False}),
+        ("due ingestion jobs", ingest_queue_collection, {"status": "pending", "next_attempt_at": {"$lte": datetime.now()}}),
+    ]
+
+
+def _stages(plan):
+    """Yields every stage name in an explain() plan tree."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+def check_query_plans():
+    """Runs explain() on each hot query and returns the ones whose winning plan is a COLLSCAN."""
+    collscans = []
+    for name, collection, criteria in _hot_queries():
+        plan = collection.find(criteria).explain().get("queryPlanner", {}).get("winningPlan", {})
+        stages = list(_stages(plan))
+        status = "COLLSCAN" if "COLLSCAN" in stages else "ok"
+        print(f"[{status}] {name} ({collection.name}): {' <- '.join(stages) or 'no plan'}")
+        if status == "COLLSCAN":
+            collscans.append(name)
+    return collscans
+
+
+if __name__ == "__main__":
+    # python -m core.db_indexes          -> create indexes
+    # python -m core.db_indexes --check  -> create indexes, then fail on any collection scan
+    ensure_indexes()
+    if "--check" in sys.argv and check_query_plans():
+        sys.exit(1)
@@ -0,0 +1,75 @@
+import math
+import hashlib
+import threading
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (no false negatives, tunable false-positive rate)."""
+
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(self.size // 8 + 1)
+        self._lock = threading.Lock()
+
+    def _positions(self, item):
+        digest = hashlib.sha256(str(item).encode("utf-8")).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:16], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        with self._lock:
+            for pos in self._positions(item):
+                self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def __contains__(self, item):
+        return all(self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(item))
+
+
+class DedupService:
+    """
+    Answers "which of these ids are already stored?" for a collection with one `$in` query that only
+    projects the id field. An optional Bloom filter, warmed from the collection at startup, lets ids
+    that were definitely never seen skip the database entirely.
+    """
+
+    def __init__(self, collection, field, use_bloom=False, capacity=100000):
+        self.collection = collection
+        self.field = field
+        self.bloom = BloomFilter(capacity) if use_bloom else None
+        self._warm = False
+
+    def warm(self):
+        """Loads every stored id into the Bloom filter. Until this finishes every lookup hits MongoDB."""
+        if self.bloom is None:
+            return
+        for doc in self.collection.find({self.field: {"$exists": True}}, {self.field: 1, "_id": 0}):
+            self.bloom.add(doc[self.field])
+        self._warm = True
+        print(f"Dedup filter for {self.collection.name}.{self.field} warmed.")
+
+    def add(self, ids):
+        """Records ids that were just stored."""
+        if self.bloom is not None:
+            for item in ids:
+                if item:
+                    self.bloom.add(item)
+
+    def existing(self, ids):
+        """Returns the subset of ids that are already stored."""
+        candidates = [item for item in set(ids) if item]
+        if self.bloom is not None and self._warm:
+            candidates = [item for item in candidates if item in self.bloom]  # Only "maybe" ids need the DB
+        if not candidates:
+            return set()
+
+        cursor = self.collection.find({self.field: {"$in": candidates}}, {self.field: 1, "_id": 0})
+        return {doc[self.field] for doc in cursor}
+
+    def is_new(self, item):
+        return item not in self.existing([item])
+
+    def filter_new(self, documents):
+        """Keeps the documents whose id is not stored yet."""
+        stored = self.existing(doc.get(self.field) for doc in documents)
+        return [doc for doc in documents if doc.get(self.field) not in stored]
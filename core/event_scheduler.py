@@ -1,40 +1,80 @@
 from datetime import datetime, timedelta, timezone
-import os.path, pytz, uuid
+import os.path, pytz, uuid, threading
 
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 # Define the scopes for Google Calendar API
 SCOPES = ['https://www.googleapis.com/auth/calendar']
+TOKEN_PATH = os.path.join('secrets', 'token.json')              # Path to the token.json
+CREDENTIALS_PATH = os.path.join('secrets', 'credentials.json')  # Path to the credentials.json
+REFRESH_MARGIN = timedelta(minutes=5)  # Refresh the access token this long before it expires
+HTTP_TIMEOUT = 30                      # Seconds per Calendar API request
 
-def authenticate_google_calendar():
-    creds = None
-    token_path = os.path.join('secrets', 'token.json') # Path to the token.json
+class CalendarClient:
+    """
+    Process-wide Google Calendar client. Credentials are read from token.json once and only refreshed
+    (and written back) when they are close to expiry. The API client is built once per thread on its own
+    keep-alive AuthorizedHttp, since httplib2 connections can't be shared between threads.
+    """
 
-    # Check if the token.json file exists
-    if os.path.exists(token_path):
-        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-    
-    # If there are no valid credentials, authenticate the user
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            credentials_path = os.path.join('secrets', 'credentials.json') # Path to the credentials.json 
-            flow = InstalledAppFlow.from_client_secrets_file(credentials_path, SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        # Save the credentials to the token.json file inside the secrets folder
-        with open(token_path, 'w') as token:
+    def __init__(self):
+        self._creds = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _save(self, creds):
+        with open(TOKEN_PATH, 'w') as token:
             token.write(creds.to_json())
 
+    def _authorize(self):
+        """Runs the browser consent flow, as on first setup."""
+        flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
+        creds = flow.run_local_server(port=0)
+        self._save(creds)
+        return creds
+
+    def _expiring(self, creds):
+        if not creds.token:
+            return True
+        now = datetime.now(timezone.utc).replace(tzinfo=None)  # google-auth keeps expiry as naive UTC
+        return creds.expiry is not None and creds.expiry - now < REFRESH_MARGIN
+
+    def credentials(self):
+        """Returns the shared credentials, refreshing them first if they are about to expire."""
+        with self._lock:
+            if self._creds is None and os.path.exists(TOKEN_PATH):
+                self._creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+
+            if not self._creds or (self._expiring(self._creds) and not self._creds.refresh_token):
+                self._creds = self._authorize()
+            elif self._expiring(self._creds):
+                self._creds.refresh(Request())
+                self._save(self._creds)
+            return self._creds
+
+    def service(self):
+        """Returns this thread's Calendar API client, building it on first use."""
+        creds = self.credentials()
+        local = self._local
+        if getattr(local, "creds", None) is not creds:  # First use on this thread, or re-authorized since
+            http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+            local.service = build('calendar', 'v3', http=http, cache_discovery=False)
+            local.creds = creds
+        return local.service
+
+
+calendar_client = CalendarClient()
+
+def authenticate_google_calendar():
     try:
-        # Build the Google Calendar API service
-        service = build('calendar', 'v3', credentials=creds)
-        return service
+        # Cached Google Calendar API service for this thread
+        return calendar_client.service()
     except HttpError as error:
         print(f"An error occurred: {error}")
         return None
@@ -31,13 +31,106 @@ from setups import health_collection, message_collection, email_collection, \
 # insight_collection = db['insights']
 
 # ---------------------------- Export data for analysis
-def csv_for_analysis(purpose: str, date: str):
+PURPOSES = ["daily summary", "weekly health report"]
+
+DAILY_HEADER = [
+    "Source", "Message ID", "Email ID", "Sender", "Timestamp", "Message",
+    "Tasks", "Task Due Date", "Task Location", "Task Method", "Task People", "Task Priority", "Task Status",
+    "Insights"
+]
+
+HEALTH_HEADER = [
+    "Timestamp",
+    "Flights Climbed", "Active Energy", "Basal Energy Burned", "Step Count", "Walking Running Distance", "Headphone Audio Exposure",
+    "Walking Step Length", "Walking Speed", "Walking Asymmetry Percentage", "Walking Double Support Percentage",
+    "Heart Rate",
+    "Message"
+]
+HEALTH_FIELDS = [
+    "timestamp",
+    "flights_climbed", "active_energy", "basal_energy_burned", "step_count", "walking_running_distance", "headphone_audio_exposure",
+    "walking_step_length", "walking_speed", "walking_asymmetry_percentage", "walking_double_support_percentage",
+    "hr",
+    "message"
+]
+
+TASK_FIELDS = ["what", "when", "where", "how", "with_whom", "priority", "status"]
+TASK_DEFAULTS = {"status": "pending"}
+CURSOR_BATCH_SIZE = 500
+
+
+def _joined(id_field):
+    """$lookup stages attaching the tasks and insights created from each message/email (index-backed equality joins)."""
+    return [
+        {"$lookup": {"from": task_collection.name, "localField": id_field, "foreignField": id_field, "as": "tasks"}},
+        {"$lookup": {"from": insight_collection.name, "localField": id_field, "foreignField": id_field, "as": "insights"}},
+    ]
+
+
+def _daily_pipeline(start_of_day, end_of_day):
+    """One server-side pass: the day's WhatsApp messages, then the day's emails, each joined with tasks and insights."""
+    related = {
+        "_id": 0, "sender": 1,
+        **{f"tasks.{field}": 1 for field in TASK_FIELDS},
+        "insights.insights": 1,
+    }
+    return [
+        {"$match": {"timestamp": {"$gte": start_of_day, "$lt": end_of_day}}},
+        *_joined("message_id"),
+        {"$project": {**related, "source": "WhatsApp", "message_id": 1, "timestamp": 1, "message": 1}},
+        {"$unionWith": {"coll": email_collection.name, "pipeline": [
+            {"$match": {"received_time": {"$gte": start_of_day, "$lt": end_of_day}}},
+            *_joined("email_id"),
+            {"$project": {**related, "source": "Email", "email_id": 1,
+                          "timestamp": "$received_time", "message": "$body"}},
+        ]}},
+    ]
+
+
+def _join(values):
+    return " | ".join(value if value is not None else "" for value in values)
+
+
+def _daily_rows(date):
+    """Streams fully joined daily summary rows from the aggregation cursor."""
+    start_of_day = date
+    end_of_day = (datetime.datetime.strptime(date, "%Y-%m-%d") + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+
+    cursor = message_collection.aggregate(_daily_pipeline(start_of_day, end_of_day), batchSize=CURSOR_BATCH_SIZE)
+    for entry in cursor:
+        tasks = entry.get("tasks", [])
+        yield [
+            entry["source"], entry.get("message_id", ""), entry.get("email_id", ""), entry.get("sender", "Unknown"),
+            entry.get("timestamp", ""), entry.get("message", ""),
+            *[_join(task.get(field, TASK_DEFAULTS.get(field, "")) for task in tasks) for field in TASK_FIELDS],
+            " | ".join(", ".join(i.get("insights", [])) for i in entry.get("insights", [])),
+        ]
+
+
+def _health_rows(date):
+    """Streams the last seven days of health data through the same aggregation engine."""
+    start_date = (datetime.datetime.strptime(date, "%Y-%m-%d") - datetime.timedelta(days=6)).strftime("%Y-%m-%d")
+    pipeline = [
+        {"$match": {"timestamp": {"$gte": start_date, "$lte": date}}},
+        {"$sort": {"timestamp": 1}},
+        {"$project": {"_id": 0, **{field: 1 for field in HEALTH_FIELDS}}},
+    ]
+    try:
+        cursor = health_collection.aggregate(pipeline, batchSize=CURSOR_BATCH_SIZE)
+    except Exception as e:
+        print(f"Error fetching health data: {e}")
+        return
+
+    for entry in cursor:
+        yield [entry.get(field, "") for field in HEALTH_FIELDS]
+
+
+def stream_rows(purpose: str, date: str):
     """
-    Fetches data from MongoDB based on the given purpose and date, writes it to a CSV file,
-    and saves it in the 'csv' folder in the main working directory.
+    Validates the purpose and date and returns (header, rows), where rows is a generator
+    streaming the joined records straight from MongoDB.
     """
-    # Validate purpose and date
-    if purpose.lower() not in ["daily summary", "weekly health report"]:
+    if purpose.lower() not in PURPOSES:
         raise ValueError("Invalid purpose. Choose 'daily summary' or 'weekly health report'.")
 
     try:
@@ -45,6 +138,24 @@ def csv_for_analysis(purpose: str, date: str):
     except ValueError:
         raise ValueError("Invalid date format. Use 'YYYY-MM-DD'.")
 
+    if purpose.lower() == "daily summary":
+        return DAILY_HEADER, _daily_rows(date)
+    return HEALTH_HEADER, _health_rows(date)
+
+
+def records_for_analysis(purpose: str, date: str):
+    """Streams the joined records as dicts keyed by the export header, without writing a file."""
+    header, rows = stream_rows(purpose, date)
+    return (dict(zip(header, row)) for row in rows)
+
+
+def csv_for_analysis(purpose: str, date: str):
+    """
+    Fetches data from MongoDB based on the given purpose and date, writes it to a CSV file,
+    and saves it in the 'csv' folder in the main working directory.
+    """
+    header, rows = stream_rows(purpose, date)
+
     # Ensure the 'csv' directory exists
     csv_dir = Path("csv")
     csv_dir.mkdir(exist_ok=True)
@@ -53,115 +164,12 @@ def csv_for_analysis(purpose: str, date: str):
     file_name = f"{purpose.replace(' ', '_').lower()}_{date}.csv"
     file_path = csv_dir / file_name
 
-    # Open the CSV file for writing
     with open(file_path, mode="w", newline="", encoding="utf-8") as file:
         writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
 
-        # Fetch data based on the purpose
-        if purpose.lower() == "daily summary":
-            # Define header for CSV
-            header = [
-                "Source", "Message ID", "Email ID", "Sender", "Timestamp", "Message",
-                "Tasks", "Task Due Date", "Task Location", "Task Method", "Task People", "Task Priority", "Task Status",
-                "Insights"
-            ]
-            writer.writerow(header)
-
-            start_of_day = date
-            end_of_day = (datetime.datetime.strptime(date, "%Y-%m-%d") + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-
-            messages = list(message_collection.find({"timestamp": {"$gte": start_of_day, "$lt": end_of_day}}))
-            emails = list(email_collection.find({"timestamp": {"$gte": start_of_day, "$lt": end_of_day}}))
-            data_entries = messages + emails
-
-            # Process each message/email and fetch associated tasks & insights
-            for entry in data_entries:
-                source = "WhatsApp" if "message_id" in entry else "Email"
-                message_id = entry.get("message_id", "")
-                email_id = entry.get("email_id", "")
-                sender = entry.get("sender", "Unknown")
-                timestamp = entry.get("timestamp", "")
-                message = entry.get("message", "")
-
-                # Fetch related tasks
-                tasks = list(task_collection.find({"$or": [{"message_id": message_id}, {"email_id": email_id}]}))
-                task_strs = []
-                task_due_dates = []
-                task_locations = []
-                task_methods = []
-                task_people = []
-                task_priorities = []
-                task_statuses = []
-
-                for task in tasks:
-                    task_strs.append(task.get("what", ""))
-                    task_due_dates.append(task.get("when", ""))
-                    task_locations.append(task.get("where", ""))
-                    task_methods.append(task.get("how", ""))
-                    task_people.append(task.get("with_whom", ""))
-                    task_priorities.append(task.get("priority", ""))
-                    task_statuses.append(task.get("status", "pending"))
-
-                # Join multiple tasks with a separator
-                task_strs = " | ".join([task if task is not None else "" for task in task_strs])
-                task_due_dates = " | ".join([date if date is not None else "" for date in task_due_dates])
-                task_locations = " | ".join([loc if loc is not None else "" for loc in task_locations])
-                task_methods = " | ".join([method if method is not None else "" for method in task_methods])
-                task_people = " | ".join([person if person is not None else "" for person in task_people])
-                task_priorities = " | ".join([priority if priority is not None else "" for priority in task_priorities])
-                task_statuses = " | ".join([status if status is not None else "" for status in task_statuses])
-
-                # Fetch related insights
-                insights = list(insight_collection.find({"$or": [{"message_id": message_id}, {"email_id": email_id}]}))
-                insights_str = " | ".join([", ".join(i.get("insights", [])) for i in insights])
-
-                # Write to CSV
-                writer.writerow([
-                    source, message_id, email_id, sender, timestamp, message,
-                    task_strs, task_due_dates, task_locations, task_methods, task_people, task_priorities, task_statuses,
-                    insights_str
-                ])
-
-            return str(file_path)
-
-        elif purpose.lower() == "weekly health report":
-            start_date = (datetime.datetime.strptime(date, "%Y-%m-%d") - datetime.timedelta(days=6)).strftime("%Y-%m-%d")
-            try:
-                health_data = list(health_collection.find({"timestamp": {"$gte": start_date, "$lte": date}}))
-            except Exception as e:
-                print(f"Error fetching health data: {e}")
-                health_data = []
-
-            headers = [
-                "Timestamp",
-                "Flights Climbed", "Active Energy", "Basal Energy Burned", "Step Count", "Walking Running Distance", "Headphone Audio Exposure",
-                "Walking Step Length", "Walking Speed", "Walking Asymmetry Percentage", "Walking Double Support Percentage",
-                "Heart Rate",
-                "Message"
-            ]
-            writer.writerow(headers)
-            for entry in health_data:
-                writer.writerow([
-                    entry.get("timestamp", ""),  # Timestamp
-                    entry.get("flights_climbed", ""),  # Flights Climbed
-                    entry.get("active_energy", ""),  # Active Energy
-                    entry.get("basal_energy_burned", ""),  # Basal Energy Burned
-                    entry.get("step_count", ""),  # Step Count
-                    entry.get("walking_running_distance", ""),  # Walking Running Distance
-                    entry.get("headphone_audio_exposure", ""),  # Headphone Audio Exposure
-                    entry.get("walking_step_length", ""),  # Walking Step Length
-                    entry.get("walking_speed", ""),  # Walking Speed
-                    entry.get("walking_asymmetry_percentage", ""),  # Walking Asymmetry Percentage
-                    entry.get("walking_double_support_percentage", ""),  # Walking Double Support Percentage
-                    entry.get("hr", ""),  # Heart Rate
-                    entry.get("message", "")  # Message
-                ])
-
-            return str(file_path)
-
-        else:
-            raise ValueError("Invalid purpose. Choose 'daily summary' or 'weekly health report'.")
-            return None
+    return str(file_path)
 
 
 def fetch_data(collection, criteria):
@@ -1,98 +1,224 @@
+import re
 import email
 import imaplib
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 
+from pymongo.errors import DuplicateKeyError
+
+from setups import mail_sync_collection
+from services.imap_parser import group_fetch_response, parse_bodystructure, find_text_part, decode_body
+
+# ---------------------------- IMAP sync setup
+MAILBOX = "inbox"
+PRIMARY_FILTER = 'X-GM-RAW "category:primary"'  # Gmail-specific filter: only the Primary tab
+FETCH_BATCH_SIZE = 50                           # UIDs requested per FETCH while draining a backlog
+MAX_BODY_BYTES = 64 * 1024                      # Size cap for the downloaded text part
+HEADER_FETCH = "(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])"
+
+
+def connect(IMAP_SERVER, EMAIL_ACCOUNT, EMAIL_PASSWORD):
+    """Opens an authenticated IMAP connection."""
+    mail = imaplib.IMAP4_SSL(IMAP_SERVER, 993)
+    mail.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
+    return mail
+
+
+def _uidvalidity(mail):
+    """Returns the UIDVALIDITY of the selected mailbox."""
+    _, data = mail.response("UIDVALIDITY")
+    if data and data[0]:
+        return int(data[0])
+
+    result, data = mail.status(MAILBOX, "(UIDVALIDITY)")
+    match = re.search(rb"UIDVALIDITY (\d+)", data[0] or b"") if result == "OK" else None
+    if not match:
+        raise RuntimeError("Could not read UIDVALIDITY")
+    return int(match.group(1))
+
+
+def _decode_headers(msg):
+    """Decodes subject, sender and received time from a parsed message (or header block)."""
+    # Decode subject
+    subject, encoding = decode_header(msg["Subject"] or "")[0]
+    if isinstance(subject, bytes):
+        subject = subject.decode(encoding or "utf-8", errors="ignore")
+    subject = subject if subject else "No Subject"
+
+    # Decode sender
+    sender, encoding = decode_header(msg["From"] or "")[0]
+    if isinstance(sender, bytes):
+        sender = sender.decode(encoding or "utf-8", errors="ignore")
+
+    # Extract email received timestamp
+    date_header = msg["Date"]
+    email_timestamp = parsedate_to_datetime(date_header).strftime("%Y-%m-%d %H:%M:%S") if date_header else ""
+    return subject, sender, email_timestamp
+
+
+def _email_data(email_id, subject, sender, body, received_time):
+    return {
+        "email_id": email_id,
+        "subject": subject,
+        "sender": sender,
+        "body": body.strip(),
+        "received_time": received_time,
+        "processed": False,
+    }
+
+
+def _parse_message(raw_email, email_id):
+    """Turns a raw RFC822 message into the email dict stored by process()."""
+    msg = email.message_from_bytes(raw_email)
+    subject, sender, email_timestamp = _decode_headers(msg)
+
+    # Extract email body
+    body = ""
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            if content_type == "text/plain":
+                body = part.get_payload(decode=True).decode(errors="ignore")
+                break
+    else:
+        body = msg.get_payload(decode=True).decode(errors="ignore")
+
+    return _email_data(email_id, subject, sender, body, email_timestamp)
+
+
+def _fetch_full(mail, uid, uidvalidity):
+    """Fallback: downloads one whole message when its BODYSTRUCTURE could not be parsed."""
+    result, msg_data = mail.uid("FETCH", str(uid), "(RFC822)")
+    if result != "OK":
+        return None
+    for response_part in msg_data:
+        if isinstance(response_part, tuple):
+            return _parse_message(response_part[1], f"{uidvalidity}:{uid}")
+    return None
+
+
+def _fetch_uids(mail, uids, uidvalidity):
+    """
+    Fetches a set of UIDs with as few round-trips as possible: one FETCH for the BODYSTRUCTURE and
+    headers of every message, then one FETCH per distinct text-part section for just that part,
+    capped at MAX_BODY_BYTES. Attachments are never downloaded.
+    """
+    result, data = mail.uid("FETCH", ",".join(map(str, uids)), HEADER_FETCH)
+    if result != "OK":
+        return []
+
+    messages, sections, fallback = {}, {}, []
+    for record in group_fetch_response(data):
+        structure = parse_bodystructure(record["meta"])
+        if structure is None:
+            fallback.append(record["uid"])
+            continue
+
+        text_part = find_text_part(structure)
+
+        messages[record["uid"]] = {"headers": email.message_from_bytes(record["literal"] or b""), "part": text_part}
+        if text_part:
+            sections.setdefault(text_part["part"], []).append(record["uid"])
+
+    # Pull only the text part, grouped by section so one FETCH covers many messages
+    bodies = {}
+    for section, section_uids in sections.items():
+        result, data = mail.uid(
+            "FETCH", ",".join(map(str, section_uids)), f"(UID BODY.PEEK[{section}]<0.{MAX_BODY_BYTES}>)"
+        )
+        if result == "OK":
+            bodies.update({record["uid"]: record["literal"] for record in group_fetch_response(data)})
+
+    fetched = []
+    for uid in uids:
+        if uid in messages:
+            message = messages[uid]
+            part = message["part"]
+            body = decode_body(bodies.get(uid), part["encoding"], part["charset"]) if part else ""
+            fetched.append(_email_data(f"{uidvalidity}:{uid}", *_decode_headers(message["headers"]), body))
+        elif uid in fallback:
+            email_data = _fetch_full(mail, uid, uidvalidity)
+            if email_data:
+                fetched.append(email_data)
+    return fetched
+
+
+def email_uid(email_data):
+    """The IMAP UID inside a "<uidvalidity>:<uid>" email id."""
+    return int(email_data["email_id"].rsplit(":", 1)[1])
+
+
+def sync_mailbox(mail, max_emails=5):
+    """
+    Incremental sync using UIDs. The mailbox's UIDVALIDITY and the highest UID seen are kept in MongoDB,
+    and only `UID last+1:*` is searched, so every new message is fetched exactly once however large the
+    backlog is. On the first sync (or when UIDVALIDITY changes) only the latest `max_emails` are taken.
+    Email ids are "<uidvalidity>:<uid>", which stay stable unlike sequence numbers.
+
+    Returns (emails, mark). The mark is not saved here: the caller passes it to save_sync_mark once the
+    emails are stored or queued. It already stops before the first UID whose FETCH failed.
+    """
+    mail.select(MAILBOX)
+    uidvalidity = _uidvalidity(mail)
+
+    state = mail_sync_collection.find_one({"mailbox": MAILBOX})
+    resume = bool(state and state.get("uidvalidity") == uidvalidity)
+    last_uid = state["last_uid"] if resume else 0
+
+    result, data = mail.uid("SEARCH", None, f"UID {last_uid + 1}:*", PRIMARY_FILTER)
+    if result != "OK":
+        raise RuntimeError(f"IMAP search failed: {result}")
+
+    # "n:*" always matches the newest message, even when its UID is below n
+    uids = sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)
+    if not resume:
+        uids = uids[-max_emails:]
+    if not uids:
+        return [], None
+
+    emails = []
+    for i in range(0, len(uids), FETCH_BATCH_SIZE):
+        emails.extend(_fetch_uids(mail, uids[i:i + FETCH_BATCH_SIZE], uidvalidity))
+
+    fetched = {email_uid(email_data) for email_data in emails}
+    missing = [uid for uid in uids if uid not in fetched]
+    mark = {"uidvalidity": uidvalidity, "last_uid": missing[0] - 1 if missing else uids[-1]}
+    return emails, mark
+
+
+def settle_mark(mark, emails, failed_ids):
+    """Pulls the mark back to just before the first email that failed to be processed or queued."""
+    failed = [email_uid(email_data) for email_data in emails if email_data["email_id"] in failed_ids]
+    if mark is None or not failed:
+        return mark
+    return {**mark, "last_uid": min(mark["last_uid"], min(failed) - 1)}
+
+
+def save_sync_mark(mark):
+    """Records how far the mailbox is synced. Call only after the emails up to the mark are stored or queued."""
+    if mark is None:
+        return
+    try:
+        # Never moves the mark backwards: a concurrent sync may already have saved a later one
+        mail_sync_collection.update_one(
+            {"mailbox": MAILBOX, "$or": [{"uidvalidity": {"$ne": mark["uidvalidity"]}},
+                                         {"last_uid": {"$lt": mark["last_uid"]}}]},
+            {"$set": mark},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        pass  # The stored mark is already at or past this one
+
+
 def fetch_mail(IMAP_SERVER, EMAIL_ACCOUNT, EMAIL_PASSWORD, max_emails=5):
+    """Logs in, fetches the emails that arrived since the last sync and logs out. Returns (emails, mark)."""
     try:
-        # print("Connecting to IMAP server...")  
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, 993)
-
-        # print("Logging into email account...")  
-        mail.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-
-        # print("Selecting Inbox...")  
-        mail.select("inbox")  
-
-        # print("Selecting Primary Inbox...")
-        # Gmail-specific IMAP filter to fetch emails only from the Primary tab
-        result, data = mail.search(None, 'X-GM-RAW "category:primary"')
-
-        if result != "OK":
-            # print("IMAP search failed:", result)
-            return {"error": "IMAP search failed"}
-        
-        # print("Geting Latest Emails...")
-        email_ids = data[0].split()[-max_emails:]  # Get latest emails
-
-        if not email_ids:
-            # print("No new emails found in Primary inbox.")
-            return []
-
-        saved_emails = []
-        for e_id in email_ids:
-            result, msg_data = mail.fetch(e_id, "(RFC822)")
-            if result != "OK":
-                # print(f"Failed to fetch email {e_id}: {result}")
-                continue
-
-            for response_part in msg_data:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_bytes(response_part[1])
-
-                    # Decode subject
-                    subject, encoding = decode_header(msg["Subject"])[0]
-                    if isinstance(subject, bytes) and encoding:
-                        subject = subject.decode(encoding)
-                    subject = subject if subject else "No Subject"
-
-                    # Decode sender
-                    sender, encoding = decode_header(msg["From"])[0]
-                    if isinstance(sender, bytes) and encoding:
-                        sender = sender.decode(encoding)
-
-                    # Extract email received timestamp
-                    date_header = msg["Date"]
-                    email_timestamp = parsedate_to_datetime(date_header).strftime("%Y-%m-%d %H:%M:%S")
-
-                    # Extract email body
-                    body = ""
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            content_type = part.get_content_type()
-                            if content_type == "text/plain":
-                                body = part.get_payload(decode=True).decode(errors="ignore")
-                                break
-                    else:
-                        body = msg.get_payload(decode=True).decode(errors="ignore")
-
-                    email_data = {
-                        "email_id": e_id.decode() if isinstance(e_id, bytes) else str(e_id),
-                        "subject": subject,
-                        "sender": sender,
-                        "body": body.strip(),
-                        "received_time": email_timestamp,
-                        "processed": False,
-                    }
-                    
-                    saved_emails.append(email_data)
-
-        mail.logout()
-
-        # print(len(saved_emails), "new emails fetched.")  
-        # for email_data in saved_emails:
-        #     print(f"""
-        #     =========================================
-        #     Email ID: {email_data['email_id']}
-        #     Sender: {email_data['sender']}
-        #     Subject: {email_data['subject']}
-        #     Received Time: {email_data['received_time']}
-        #     =========================================
-        #     """)
-
-        # print("Emails Fetched Successfully.")
-        return saved_emails
+        mail = connect(IMAP_SERVER, EMAIL_ACCOUNT, EMAIL_PASSWORD)
+        try:
+            return sync_mailbox(mail, max_emails)
+        finally:
+            mail.logout()
 
     except Exception as e:
-        # print("Email Fetch Error:", str(e))  
-        return {"error": str(e)}
+        # print("Email Fetch Error:", str(e))
+        return {"error": str(e)}, None
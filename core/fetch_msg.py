@@ -1,45 +1,92 @@
 import time
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-from services.dnt_vns import download_media, transcribe_audio
+from setups import MEDIA_WORKERS
+from services.dnt_vns import download_media, transcribe_batch, transcribe_audio
 
-# ---------------------------- VNs setup
-VOICE_NOTES_DIR = Path("voice_notes")
+# ---------------------------- Media setup
+# Shared across requests so concurrent webhooks can't open an unbounded number of downloads
+media_executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
 
-def fetch_msg(request_data):
-    """Processes an incoming WhatsApp message, including media handling."""
-    
-    message_id = request_data.get('MessageSid', '')
-    sender = request_data.get('From', '')
-    incoming_msg = request_data.get('Body', '')
-    num_media = int(request_data.get('NumMedia', 0))
-
-    message_data = {
-        "message_id": message_id,
-        "sender": sender,
-        "message": incoming_msg,
-        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-        "media_urls": [],
-        "processed": False,
-    }
-
-    # Handle voice notes
-    if num_media > 0:
-        for i in range(num_media):
-            media_url = request_data.get(f"MediaUrl{i}")
-            media_type = request_data.get(f"MediaContentType{i}", "")
-
-            if media_type.startswith("audio/"):
-                VOICE_NOTES_DIR.mkdir(exist_ok=True)
-                file_name = f"{message_id}_{i}.ogg"
-                file_path = VOICE_NOTES_DIR / file_name
-
-                if download_media(media_url, file_path):
-                    transcribed_text = transcribe_audio(file_path)
-                    message_data["message"] = transcribed_text
-                    message_data["media_urls"].append(str(file_path))
-
-    print(f""" Message from Fetch_MSG module:
+
+def _voice_note_urls(request_data):
+    urls = []
+    for i in range(int(request_data.get('NumMedia', 0))):
+        media_url = request_data.get(f"MediaUrl{i}")
+        media_type = request_data.get(f"MediaContentType{i}", "")
+        if media_url and media_type.startswith("audio/"):
+            urls.append(media_url)
+    return urls
+
+
+def _download(future):
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"Failed to download media: {e}")
+        return None
+
+
+def _transcribe(audio_files):
+    """Transcribes the notes as one batch; if the batch itself fails, note by note so errors stay per note."""
+    try:
+        return transcribe_batch(audio_files)
+    except Exception as e:
+        print(f"Batch transcription failed, retrying note by note: {e}")
+
+    transcripts = []
+    for audio_file in audio_files:
+        try:
+            transcripts.append(transcribe_audio(audio_file))
+        except Exception as e:
+            print(f"Error transcribing audio: {e}")
+            transcripts.append("Transcription error")
+    return transcripts
+
+
+def fetch_msgs(forms):
+    """
+    Processes a batch of incoming WhatsApp messages. Voice notes from every message are downloaded at
+    once and transcribed as one batch; each message gets its transcripts in attachment order.
+    A message that can't be read comes back as the exception, without affecting the others.
+    """
+    notes, failed = [], {}
+    for n, form in enumerate(forms):
+        try:
+            notes.extend((n, media_url) for media_url in _voice_note_urls(form))
+        except Exception as e:
+            failed[n] = e
+
+    downloads = [media_executor.submit(download_media, media_url) for _, media_url in notes]
+    audio_files = [_download(future) for future in downloads]  # In memory, never written to disk
+
+    downloaded = [(note, audio_file) for note, audio_file in zip(notes, audio_files) if audio_file]
+    transcripts = _transcribe([audio_file for _, audio_file in downloaded]) if downloaded else []
+
+    messages = []
+    for n, request_data in enumerate(forms):
+        if n in failed:
+            messages.append(failed[n])
+            continue
+
+        message_data = {
+            "message_id": request_data.get('MessageSid', ''),
+            "sender": request_data.get('From', ''),
+            "message": request_data.get('Body', ''),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "media_urls": [],
+            "processed": False,
+        }
+
+        texts = []
+        for ((note_n, media_url), _), transcribed_text in zip(downloaded, transcripts):
+            if note_n == n:
+                texts.append(transcribed_text)
+                message_data["media_urls"].append(media_url)
+        if texts:
+            message_data["message"] = "\n".join(([message_data["message"]] if message_data["message"] else []) + texts)
+
+        print(f""" Message from Fetch_MSG module:
     =========================================
     Message ID: {message_data['message_id']}
     Sender: {message_data['sender']}
@@ -48,5 +95,14 @@ def fetch_msg(request_data):
     Media URLs: {', '.join(message_data['media_urls']) if message_data['media_urls'] else 'None'}
     =========================================
     """)
+        messages.append(message_data)
+
+    return messages
+
 
-    return message_data
\ No newline at end of file
+def fetch_msg(request_data):
+    """Processes an incoming WhatsApp message, including media handling."""
+    message_data = fetch_msgs([request_data])[0]
+    if isinstance(message_data, Exception):
+        raise message_data
+    return message_data
@@ -0,0 +1,176 @@
+import queue
+import threading
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+from setups import ingest_queue_collection, INGEST_WORKERS, INGEST_MAX_PENDING, INGEST_MAX_ATTEMPTS, \
+                   INGEST_BATCH_SIZE
+
+# ---------------------------- Queue setup
+POLL_INTERVAL = 5       # Seconds an idle worker waits before sweeping MongoDB for due jobs
+LEASE_SECONDS = 300     # Jobs left in "processing" longer than this are treated as orphaned
+MAX_BACKOFF = 600       # Upper bound (seconds) for the retry delay
+
+_wakeups = queue.Queue(maxsize=INGEST_MAX_PENDING)  # Ids of freshly queued jobs; overflow is found by sweeps
+_handlers = {}
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def register_handler(source, handler):
+    """
+    Registers the function that runs the pipeline for jobs of the given source.
+    The handler receives a list of payloads and returns a list with one error per payload
+    (None on success). Raising fails the whole batch.
+    """
+    _handlers[source] = handler
+
+
+# ---------------------------- Producer side
+def enqueue(source, job_id, payload):
+    """
+    Persists an inbound item in the ingestion queue and wakes up a worker.
+    Returns False when the backlog is full so the caller can refuse the request.
+    Duplicate deliveries of the same job_id are acknowledged without queueing twice.
+    """
+    # The backlog lives in MongoDB (retries and jobs from before a restart included), so count it there
+    backlog = ingest_queue_collection.count_documents(
+        {"status": {"$in": ["pending", "processing"]}}, limit=INGEST_MAX_PENDING
+    )
+    if backlog >= INGEST_MAX_PENDING:
+        return False
+
+    now = datetime.now()
+    result = ingest_queue_collection.update_one(
+        {"source": source, "job_id": job_id},
+        {"$setOnInsert": {
+            "source": source,
+            "job_id": job_id,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "last_error": None,
+            "created_at": now,
+            "next_attempt_at": now,
+        }},
+        upsert=True,
+    )
+    if result.upserted_id is None:
+        return True  # Already queued by an earlier delivery
+
+    try:
+        _wakeups.put_nowait(result.upserted_id)
+    except queue.Full:
+        pass  # Job is persisted, a sweeping worker will still pick it up
+    return True
+
+
+# ---------------------------- Worker side
+def _expired_lease(now):
+    return {"status": "processing", "locked_at": {"$lt": now - timedelta(seconds=LEASE_SECONDS)}}
+
+
+def _fail_orphans():
+    """
+    Fails jobs whose lease expired on their last allowed attempt. A job that kills its worker never
+    reaches _retry_or_fail, so without this it would be reclaimed forever.
+    """
+    now = datetime.now()
+    result = ingest_queue_collection.update_many(
+        {**_expired_lease(now), "attempts": {"$gte": INGEST_MAX_ATTEMPTS}},
+        {"$set": {"status": "failed", "finished_at": now, "last_error": "lease expired (worker died?)"},
+         "$unset": {"locked_at": ""}},
+    )
+    if result.modified_count:
+        print(f"Failed {result.modified_count} ingestion job(s) abandoned on their last attempt.")
+
+
+def _claim(criteria):
+    """Atomically moves one due job matching the criteria to "processing" and returns it."""
+    now = datetime.now()
+    due = {"$or": [
+        {"status": "pending", "next_attempt_at": {"$lte": now}},
+        {**_expired_lease(now), "attempts": {"$lt": INGEST_MAX_ATTEMPTS}},  # Reclaiming costs an attempt too
+    ]}
+    return ingest_queue_collection.find_one_and_update(
+        {**criteria, **due},
+        {"$set": {"status": "processing", "locked_at": now}, "$inc": {"attempts": 1}},
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def _claim_batch(first):
+    """Claims more due jobs of the same source as `first`, up to INGEST_BATCH_SIZE in total."""
+    jobs = [first]
+    while len(jobs) < INGEST_BATCH_SIZE:
+        job = _claim({"source": first["source"]})
+        if not job:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def _run(jobs):
+    """Runs the registered handler for a batch of claimed jobs and records each outcome."""
+    try:
+        handler = _handlers.get(jobs[0]["source"])
+        if handler is None:
+            raise RuntimeError(f"No handler registered for source '{jobs[0]['source']}'")
+        errors = handler([job["payload"] for job in jobs])
+    except Exception as e:
+        errors = [e] * len(jobs)
+
+    for job, error in zip(jobs, errors):
+        if error:
+            _retry_or_fail(job, error)
+            continue
+        ingest_queue_collection.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"status": "done", "finished_at": datetime.now(), "last_error": None},
+             "$unset": {"locked_at": ""}},
+        )
+
+
+def _retry_or_fail(job, error):
+    """Schedules the job for another attempt with exponential backoff, or marks it failed."""
+    print(f"Ingestion job {job['source']}:{job['job_id']} failed (attempt {job['attempts']}): {error}")
+    update = {"last_error": str(error)}
+
+    if job["attempts"] >= INGEST_MAX_ATTEMPTS:
+        update.update({"status": "failed", "finished_at": datetime.now()})
+    else:
+        delay = min(5 * 2 ** job["attempts"], MAX_BACKOFF)
+        update.update({"status": "pending", "next_attempt_at": datetime.now() + timedelta(seconds=delay)})
+
+    ingest_queue_collection.update_one({"_id": job["_id"]}, {"$set": update, "$unset": {"locked_at": ""}})
+
+
+def _worker():
+    while True:
+        try:
+            try:
+                job = _claim({"_id": _wakeups.get(timeout=POLL_INTERVAL)})
+            except queue.Empty:
+                _fail_orphans()
+                job = _claim({})  # Sweep for retries and jobs orphaned by a restart
+
+            # Keep draining while there is due work, without waiting for wake-ups
+            while job:
+                _run(_claim_batch(job))
+                job = _claim({})
+        except Exception as e:
+            print(f"Ingestion worker error: {e}")
+
+
+def start_workers(count=INGEST_WORKERS):
+    """Starts the ingestion worker pool (only once per process)."""
+    with _workers_lock:
+        if _workers:
+            return
+
+        for i in range(count):
+            worker = threading.Thread(target=_worker, name=f"ingest-worker-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
@@ -0,0 +1,116 @@
+import time
+import select
+import threading
+
+from core.fetch_email import connect, sync_mailbox, save_sync_mark
+
+# ---------------------------- IDLE listener setup
+IDLE_TIMEOUT = 25 * 60   # Re-issue IDLE before servers drop it (RFC 2177 recommends < 29 minutes)
+MIN_BACKOFF = 1          # Seconds before the first reconnect attempt
+MAX_BACKOFF = 300        # Upper bound (seconds) between reconnect attempts
+DONE_TIMEOUT = 60        # Seconds to wait for the server to confirm the end of an IDLE
+
+
+class _LineReader:
+    """
+    Reads CRLF-terminated lines straight from the socket, waiting with select() up to a deadline.
+    The socket never gets a timeout: a timed-out read leaves imaplib's reader unusable for good.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b""
+
+    def readline(self, deadline=None):
+        """Returns the next line, or None if the deadline passed first."""
+        while b"\n" not in self.buffer:
+            if not self.sock.pending():  # Bytes TLS already decrypted don't wake select()
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                readable, _, _ = select.select([self.sock], [], [], timeout)
+                if not readable:
+                    return None
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("IMAP connection closed during IDLE")
+            self.buffer += chunk
+        line, _, self.buffer = self.buffer.partition(b"\n")
+        return line + b"\n"
+
+
+class MailListener(threading.Thread):
+    """
+    Keeps one long-lived IMAP connection open and waits for new mail with IDLE instead of polling.
+    After every wake-up (and once on connect) the mailbox is synced incrementally and the new emails
+    are handed to `on_emails`; the sync mark is saved only after it returns. Connection errors trigger
+    a reconnect with exponential backoff.
+    """
+
+    def __init__(self, server, account, password, on_emails, max_emails=5):
+        super().__init__(name="imap-idle-listener", daemon=True)
+        self.server = server
+        self.account = account
+        self.password = password
+        self.on_emails = on_emails
+        self.max_emails = max_emails
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        backoff = MIN_BACKOFF
+        while not self._stop_event.is_set():
+            mail = None
+            try:
+                mail = connect(self.server, self.account, self.password)
+                print("IMAP IDLE listener connected.")
+                backoff = MIN_BACKOFF
+                self._listen(mail)
+            except Exception as e:
+                print(f"IMAP IDLE listener error: {e}. Reconnecting in {backoff}s.")
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+            finally:
+                if mail is not None:
+                    try:
+                        mail.logout()
+                    except Exception:
+                        pass
+
+    def _listen(self, mail):
+        while not self._stop_event.is_set():
+            emails, mark = sync_mailbox(mail, self.max_emails)
+            if emails:
+                self.on_emails(emails)
+            save_sync_mark(mark)  # Only once on_emails has queued everything up to the mark
+            self._idle(mail)
+
+    def _idle(self, mail):
+        """
+        Runs one IDLE cycle. Returns when the server reports new mail or IDLE_TIMEOUT passes. The previous
+        command has completed, so imaplib holds no buffered input and the socket can be read directly.
+        """
+        reader = _LineReader(mail.sock)
+        tag = mail._new_tag()
+        mail.send(tag + b" IDLE\r\n")
+
+        deadline = time.monotonic() + IDLE_TIMEOUT
+        line = reader.readline(deadline)
+        if not line or not line.startswith(b"+"):
+            raise RuntimeError("Server refused IDLE")
+
+        while not self._stop_event.is_set():
+            line = reader.readline(deadline)
+            if line is None or b"EXISTS" in line:
+                break  # IDLE_TIMEOUT passed (refresh the IDLE) or new mail arrived
+
+        mail.send(b"DONE\r\n")
+        deadline = time.monotonic() + DONE_TIMEOUT
+        while True:
+            line = reader.readline(deadline)
+            if line is None:
+                raise TimeoutError("Server did not end IDLE")
+            if line.startswith(tag):
+                if b" OK" not in line:
+                    raise RuntimeError(f"IDLE failed: {line!r}")
+                return
@@ -1,14 +1,91 @@
 import time
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
 from core.event_scheduler import create_event, isRequired
+from core.daily_digest import record_item
+from core.dedup import DedupService
 from services.task_creater import create_task
 from setups import  health_collection, message_collection, email_collection, \
                     task_collection, insight_collection, call_collection, \
-                    daily_sum_collection, weekly_report_collection
+                    daily_sum_collection, weekly_report_collection, \
+                    DEDUP_BLOOM, DEDUP_BLOOM_CAPACITY
+
+# ---------------------------- Dedup services
+message_dedup = DedupService(message_collection, "message_id", use_bloom=DEDUP_BLOOM, capacity=DEDUP_BLOOM_CAPACITY)
+email_dedup = DedupService(email_collection, "email_id", use_bloom=DEDUP_BLOOM, capacity=DEDUP_BLOOM_CAPACITY)
 
 # ---------------------------- Process incoming data
+EVENT_CLAIM_TIMEOUT = 600  # Seconds before a task claimed for scheduling counts as abandoned
+STORED_CATEGORIES = ("business", "personal", "health")  # WhatsApp categories kept; the rest (spam) is dropped
+
+def _dedup_key(source, source_id, suffix):
+    """Deterministic key for documents derived from one message/email (None if it has no id)."""
+    return f"{source}:{source_id}:{suffix}" if source_id else None
+
+
+def _store_source(collection, field, data):
+    """Stores the original message/email once, already flagged as processed."""
+    document = {key: value for key, value in data.items() if key != "_id"}
+    document["processed"] = True
+    try:
+        collection.update_one({field: data[field]}, {"$setOnInsert": document}, upsert=True)
+    except DuplicateKeyError:
+        pass  # A concurrent delivery stored it first
+
+
+def _bulk_upsert(collection, operations):
+    """Runs an unordered bulk write and returns the indexes of the operations that inserted a document."""
+    try:
+        result = collection.bulk_write(operations, ordered=False)
+        upserted = set(result.upserted_ids)
+    except BulkWriteError as e:
+        errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+        if errors:
+            raise
+        upserted = {item["index"] for item in e.details.get("upserted", [])}
+
+    inserted = {i for i, op in enumerate(operations) if isinstance(op, InsertOne)}
+    return upserted | inserted
+
+
+def _claimable():
+    """Tasks owed an event, or claimed by a delivery that died before finishing (EVENT_CLAIM_TIMEOUT ago)."""
+    return {"$or": [
+        {"event_created": False},
+        {"event_created": "pending", "event_claimed_at": {"$lt": time.time() - EVENT_CLAIM_TIMEOUT}},
+    ]}
+
+
+def _schedule_task(task_id):
+    """
+    Creates the calendar event of one stored task. The task is claimed first, so two deliveries of the same
+    message (a Twilio retry, a reclaimed job) can't both create the event and send the confirmation.
+    event_created ends as True, or "failed" when create_event declines (bad time, API error): not retried.
+    """
+    task_data = task_collection.find_one_and_update(
+        {"_id": task_id, **_claimable()},
+        {"$set": {"event_created": "pending", "event_claimed_at": time.time()}},
+    )
+    if not task_data:
+        return  # Another delivery has it
+
+    try:
+        created = create_event(task_data)
+    except Exception:
+        # Hand the task back, so the queue's retry schedules it
+        task_collection.update_one({"_id": task_id, "event_created": "pending"}, {"$set": {"event_created": False}})
+        raise
+
+    task_collection.update_one({"_id": task_id}, {"$set": {"event_created": True if created else "failed"}})
+    if not created:
+        print(f"No calendar event created for task '{task_data['what']}'.")
+
+
 def process(ai_response, data, source):
     """Processes the incoming data by categorizing it into messages, tasks, insights, or health data
-       and marks the original messages as processed."""
+       and marks the original messages as processed.
+       Every write is an upsert on a unique key, so redelivered messages are not stored twice."""
 
     if not ai_response or "Category" not in ai_response:
         return {"status": "error", "message": "Invalid AI response"}, 400
@@ -21,45 +98,35 @@ def process(ai_response, data, source):
         "sender": data.get("sender", "Unknown"),
         "timestamp": data.get("timestamp", time.strftime("%Y-%m-%d %H:%M:%S")),
     }
+    source_id = identifier["message_id"] if source == "whatsapp" else identifier["email_id"]
+    category = ai_response["Category"].lower()
 
-    # Store WhatsApp messages or emails (Prevent duplicates)
-    if source == "whatsapp" and identifier["message_id"]:
-        if ai_response["Category"].lower() in ["business", "personal", "health"]:
-            if not message_collection.find_one({"message_id": identifier["message_id"]}):
-                message_collection.insert_one(data)
-                message_collection.update_one(
-                    {"message_id": identifier["message_id"]}, {"$set": {"processed": True}}
-                )
-    elif source == "email" and identifier["email_id"]:
-        if not email_collection.find_one({"email_id": identifier["email_id"]}):
-            email_collection.insert_one(data)
-            email_collection.update_one(
-                {"email_id": identifier["email_id"]}, {"$set": {"processed": True}}
-            )
-
-    # Store Health-related data
-    if ai_response["Category"].lower() == "health":
+    # Skip messages/emails that were already fully processed
+    dedup = message_dedup if source == "whatsapp" else email_dedup
+    if source_id and not dedup.is_new(source_id):
+        return {"status": "success", "message": "Already processed"}, 200
+
+    # Store Health-related data (append the text once per message, in a single upsert)
+    if category == "health":
         time_stamp = time.strftime("%Y-%m-%d")
         new_msg = data.get("message", "")
-        existing = health_collection.find_one({"timestamp": time_stamp})
-
-        if existing:
-            message = f"{existing.get('message', '')} {new_msg}".strip()
-            health_collection.update_one(
-                {"timestamp": time_stamp},
-                {"$set": {"message": message}}
-            )
-        else:
-            health_entry = {
-            "timestamp": time.strftime("%Y-%m-%d"),
-            "message": new_msg,
+        seen_ids = {"$ifNull": ["$message_ids", []]}
+        appended = {"$trim": {"input": {"$concat": [{"$ifNull": ["$message", ""]}, " ", {"$literal": new_msg}]}}}
+
+        if source_id:
+            update = {
+                "message": {"$cond": [{"$in": [{"$literal": source_id}, seen_ids]}, "$message", appended]},
+                "message_ids": {"$setUnion": [seen_ids, [{"$literal": source_id}]]},
             }
-            health_collection.insert_one(health_entry)
+        else:
+            update = {"message": appended}
+        health_collection.update_one({"timestamp": time_stamp}, [{"$set": update}], upsert=True)
 
     # Store Tasks
     processed_tasks = []
     if "Tasks" in ai_response and isinstance(ai_response["Tasks"], list):
-        for task in ai_response["Tasks"]:
+        operations = []
+        for index, task in enumerate(ai_response["Tasks"]):
             task_details = {
                 "what": task.get("What", ""),
                 "when": task.get("When", ""),
@@ -68,16 +135,34 @@ def process(ai_response, data, source):
                 "with_whom": task.get("With Whom", ""),
                 "priority": ai_response.get("Priority", None),
             }
-            
+
             task_data = create_task(task_details, identifier)
-            
-            task_collection.insert_one(task_data)
+            task_data["event_created"] = False if isRequired(task_data) else None  # False: event still owed
+            key = _dedup_key(source, source_id, f"task:{index}")
+            if key:
+                task_data["dedup_key"] = key
+                operations.append(UpdateOne({"dedup_key": key}, {"$setOnInsert": task_data}, upsert=True))
+            else:
+                operations.append(InsertOne(task_data))
             processed_tasks.append(task_data)
 
-            if isRequired(task_data):
-                create_event(task_data)
-            else:
-                print(f"Skipping task '{task_data['what']}' as it does not require scheduling.")
+        new_tasks = _bulk_upsert(task_collection, operations) if operations else set()
+
+        for index in sorted(new_tasks):
+            if processed_tasks[index]["event_created"] is None:
+                print(f"Skipping task '{processed_tasks[index]['what']}' as it does not require scheduling.")
+
+        # Schedule every task still owed an event: the ones this delivery created, plus stored ones whose
+        # event an earlier attempt failed to create (a retry finds those tasks already upserted)
+        keys = [task_data["dedup_key"] for task_data in processed_tasks if "dedup_key" in task_data]
+        owed = [task_data["_id"] for task_data in task_collection.find(
+            {"dedup_key": {"$in": keys}, **_claimable()}, {"_id": 1}
+        )] if keys else []
+        owed += [processed_tasks[index]["_id"] for index in sorted(new_tasks)
+                 if "dedup_key" not in processed_tasks[index] and processed_tasks[index]["event_created"] is False]
+
+        for task_id in owed:
+            _schedule_task(task_id)
 
     # Store Actionable Insights
     processed_insights = []
@@ -86,15 +171,57 @@ def process(ai_response, data, source):
             **identifier,
             "insights": ai_response["Actionable_Insights"],
         }
-        insight_collection.insert_one(insight_data)
+        key = _dedup_key(source, source_id, "insights")
+        if key:
+            insight_data["dedup_key"] = key
+            operation = UpdateOne({"dedup_key": key}, {"$setOnInsert": insight_data}, upsert=True)
+        else:
+            operation = InsertOne(insight_data)
+        _bulk_upsert(insight_collection, [operation])
         processed_insights.append(insight_data)
 
+    # Keep the rolling daily digest up to date (only with items that get stored below)
+    if source == "email" or category in STORED_CATEGORIES:
+        try:
+            record_item(ai_response, data, source)
+        except Exception as e:
+            print(f"Failed to update daily digest: {e}")
+
+    # Store WhatsApp messages or emails last, so a stored original means everything above is done
+    # (unique indexes prevent duplicates)
+    if source == "whatsapp" and identifier["message_id"]:
+        if category in STORED_CATEGORIES:
+            _store_source(message_collection, "message_id", data)
+            message_dedup.add([identifier["message_id"]])
+    elif source == "email" and identifier["email_id"]:
+        _store_source(email_collection, "email_id", data)
+        email_dedup.add([identifier["email_id"]])
+
     return {"status": "success", "message": "Data processed successfully"}, 200
 
 # ---------------------------- Filter out unique emails
+def _drop_legacy_copies(emails):
+    """
+    Emails stored before the UID sync have sequence-number ids, so the same mail now arrives under a new
+    "<uidvalidity>:<uid>" id. Those old documents carry no Message-ID, so match them on sender and received
+    time instead (received_time is indexed; subjects were decoded differently back then).
+    """
+    times = list({email["received_time"] for email in emails if email.get("received_time")})
+    if not times:
+        return emails
+    legacy = {
+        (doc.get("sender"), doc.get("received_time"))
+        for doc in email_collection.find(
+            {"received_time": {"$in": times}, "email_id": {"$not": {"$regex": ":"}}},
+            {"sender": 1, "received_time": 1, "_id": 0},
+        )
+    }
+    return [email for email in emails if (email.get("sender"), email.get("received_time")) not in legacy]
+
+
 def filter_email(emails):
-    """Filters out emails that already exist in the database."""
-    return [email for email in emails if not email_collection.find_one({"email_id": email["email_id"]})]
+    """Filters out emails that already exist in the database (one batched lookup, plus pre-UID copies)."""
+    return _drop_legacy_copies(email_dedup.filter_new(emails))
 
 
 # ---------------------------- Apple Health Auto Export Data
@@ -1,4 +1,4 @@
-import base64, json, asyncio, websockets, os
+import base64, json, asyncio, websockets, os, time, threading
 from flask import Flask, jsonify, request, Response
 from flask_sock import Sock
 from dotenv import load_dotenv    
@@ -11,14 +11,63 @@ from apscheduler.triggers.interval import IntervalTrigger
 import atexit
 
 load_dotenv()
+
+# ---------------------------- Audio decode workers (forked before setups or anything else starts threads)
+from services.audio_codec import start_decode_pool
+start_decode_pool()
+
 app = Flask(__name__)
 cors = CORS(app, resources={r"/*": {"origins": "*"}})  # Enable CORS for all routes
 sock = Sock(app)
 
+# ---------------------------- MongoDB indexes
+from core.db_indexes import ensure_indexes
+ensure_indexes()  # Idempotent; run `python -m core.db_indexes --check` to validate query plans
+
 # ---------------------------- Twilio webhook endpoint
-from core.fetch_msg import fetch_msg
-from ai_models.model import classify_text
-from core.store_data_db import process
+from core.fetch_msg import fetch_msgs
+from services.dnt_vns import warm_up_stt
+from ai_models.model import classify_batch, classification_cache
+from core.store_data_db import process, message_dedup, email_dedup
+from core.ingest_queue import enqueue, register_handler, start_workers
+
+def handle_whatsapp(forms):
+    """Runs the fetch/classify/store pipeline for a batch of queued WhatsApp messages."""
+    errors = [None] * len(forms)
+    fetched = []
+    stored = message_dedup.existing(form.get("MessageSid") for form in forms)  # Skip redeliveries before any download
+    pending = [i for i, form in enumerate(forms) if form.get("MessageSid") not in stored]
+    try:
+        fetched = list(zip(pending, fetch_msgs([forms[i] for i in pending])))  # Voice notes transcribed as one batch
+    except Exception as e:
+        for i in pending:
+            errors[i] = e
+
+    # A message that couldn't be read fails alone; the rest of the batch goes on
+    for i, message_data in fetched:
+        if isinstance(message_data, Exception):
+            errors[i] = message_data
+    fetched = [(i, message_data) for i, message_data in fetched if not isinstance(message_data, Exception)]
+
+    ai_msgs = classify_batch([message_data["message"] for _, message_data in fetched])  # Classify the messages
+    for (i, message_data), ai_msg in zip(fetched, ai_msgs):
+        try:
+            result, status = process(ai_msg, message_data, source="whatsapp")
+            if status != 200:
+                errors[i] = result["message"]  # Let the queue retry it
+        except Exception as e:
+            errors[i] = e
+
+    return errors
+
+register_handler("whatsapp", handle_whatsapp)
+start_workers()
+
+# Load the speech-to-text model before the first voice note needs it
+threading.Thread(target=warm_up_stt, daemon=True).start()
+
+# Warm the dedup Bloom filters in the background (no-op unless DEDUP_BLOOM=true)
+threading.Thread(target=lambda: (message_dedup.warm(), email_dedup.warm()), daemon=True).start()
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
@@ -26,11 +75,16 @@ def webhook():
     if not message_id:
         return "Invalid request: Missing message ID", 400
 
-    message_data = fetch_msg(request.form)  # Process incoming message
-    ai_msg = classify_text(message_data["message"])  # Classify the message
-    process(ai_msg, message_data, source="whatsapp")
-    
-    return "Message received", 200  
+    # Acknowledge right away, the worker pool does the heavy lifting
+    if not enqueue("whatsapp", message_id, request.form.to_dict()):
+        return "Server busy, try again later", 503
+
+    return "Message received", 200
+
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    """Reports classification cache hit/miss counters for sizing the cache."""
+    return jsonify(classification_cache.stats()), 200
 
 # ---------------------------- Gmail webhook endpoint
 # ---- Email configuration
@@ -41,13 +95,40 @@ EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 if not EMAIL_ACCOUNT or not EMAIL_PASSWORD:
     raise ValueError("Email credentials missing. Check your .env file.")
 
-from core.fetch_email import fetch_mail
+EMAIL_IDLE = os.getenv("EMAIL_IDLE", "false").lower() == "true"  # Push ingestion over IMAP IDLE instead of polling
+
+from core.fetch_email import fetch_mail, settle_mark, save_sync_mark
 from core.store_data_db import filter_email
+from core.mail_listener import MailListener
+
+def ingest_emails(emails):
+    """Runs the classify/store pipeline for fetched emails. Returns one error per email (None on success)."""
+    errors = [None] * len(emails)
+    ai_emails = classify_batch([email["body"] for email in emails])
+    for i, (email, ai_email) in enumerate(zip(emails, ai_emails)):
+        try:
+            result, status = process(ai_email, email, source="email")
+            if status != 200:
+                errors[i] = result["message"]
+        except Exception as e:
+            errors[i] = e
+    return errors
+
+register_handler("email", ingest_emails)
+
+def queue_emails(emails):
+    """Hands emails found by the IDLE listener to the durable ingestion queue, waiting out backpressure."""
+    for email in filter_email(emails):
+        while not enqueue("email", email["email_id"], email):
+            time.sleep(1)
+
+if EMAIL_IDLE:
+    MailListener(IMAP_SERVER, EMAIL_ACCOUNT, EMAIL_PASSWORD, on_emails=queue_emails).start()
 
 @app.route("/fetch_email", methods=["POST", "GET"])
 def fetch_email():
-    # Process Emails (by default it fetches top 5 emails, but you can change it by adding max_emails parameter)
-    emails = fetch_mail(IMAP_SERVER, EMAIL_ACCOUNT, EMAIL_PASSWORD)
+    # Process Emails (fetches everything since the last sync; the first sync takes the latest max_emails)
+    emails, mark = fetch_mail(IMAP_SERVER, EMAIL_ACCOUNT, EMAIL_PASSWORD)
 
     if not isinstance(emails, list):
         return jsonify({"status": "error", "message": "Failed to fetch emails from Gmail."}), 500
@@ -55,11 +136,16 @@ def fetch_email():
     unique_emails = filter_email(emails)
 
     if not unique_emails:
+        save_sync_mark(mark)
         return jsonify({"status": "success", "message": "No new emails to save."}), 200
 
-    for email in unique_emails:
-        ai_email = classify_text(email["body"])
-        process(ai_email, email, source="email")
+    errors = ingest_emails(unique_emails)
+
+    # Advance the sync mark only past emails that were stored; failed ones are fetched again next time
+    failed = {email["email_id"] for email, error in zip(unique_emails, errors) if error}
+    save_sync_mark(settle_mark(mark, emails, failed))
+    if failed:
+        return jsonify({"status": "error", "message": f"{len(failed)} email(s) failed, will retry on the next sync."}), 500
     
     return "Emails processed successfully", 200
 
@@ -78,46 +164,67 @@ def get_health_data():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # ---------------------------- AI Summary & Report Generation
-from core.fetch_data_db import csv_for_analysis
+from core.fetch_data_db import csv_for_analysis, records_for_analysis
 from ai_models.model import generate_summary, generate_report
 from core.message_sender import send_msg_self
 from core.store_data_db import store_daily_summary, store_weekly_report
+from core.daily_digest import finalize_digest, summary_so_far, fold_digest
+from setups import EXPORT_ANALYSIS_CSV
 
 @app.route("/generate_summary", methods=["POST", "GET"])
 def daily_summary():
     """Generates daily summary of all the message and emails received. Sends the summary via whatsapp and saves it in database."""
 
     date=datetime.now().strftime("%Y-%m-%d")
-    csv_path = csv_for_analysis("daily summary", date=date)
-    summary = generate_summary(csv_path)
+    if EXPORT_ANALYSIS_CSV:
+        csv_for_analysis("daily summary", date=date)  # Optional side output
+
+    # Finalize the rolling digest; rebuild from scratch only if there is none for today
+    summary = finalize_digest(date)
+    if summary is None:
+        summary = generate_summary(records_for_analysis("daily summary", date=date))
     sent = send_msg_self(summary)
     saving = store_daily_summary(date, summary)
 
-    if summary == "Error: CSV file not found.":
-        return summary, 404
     return "Summary generated", 200
 
 
+@app.route("/summary_so_far", methods=["GET"])
+def summary_so_far_route():
+    """Returns today's running digest: counts by category, open tasks, insights and the notes so far."""
+    digest = summary_so_far(datetime.now().strftime("%Y-%m-%d"))
+    if digest is None:
+        return jsonify({"status": "success", "message": "Nothing processed today yet."}), 200
+    return jsonify(digest), 200
+
+
 @app.route("/generate_report", methods=["POST", "GET"])
 def weekly_report():
     """Generates weekly report of the health data. Sends the report via whatsapp and saves it in database."""
 
     date=datetime.now().strftime("%Y-%m-%d")
-    csv_path = csv_for_analysis("weekly health report", date=date)  # Generate weekly health report    
-    report = generate_report(csv_path)
+    if EXPORT_ANALYSIS_CSV:
+        csv_for_analysis("weekly health report", date=date)  # Optional side output
+    report = generate_report(records_for_analysis("weekly health report", date=date))
     sent = send_msg_self(report)
     saving = store_weekly_report(date, report)
-    if report == "Error: CSV file not found.":
-        return report, 404
 
     return "Weekly report generated", 200
 
 # ---------------------------- Call Handling
 from twilio.twiml.voice_response import VoiceResponse, Connect, Stream
 from core.call_handler import call
-from services.call import get_context, stt_engine, make_call, tts_engine
-from setups import FROM, message_collection, twilio_client, NGROK_URL
-active_calls = {}
+from core.call_sessions import sessions
+from services.call import get_context, make_call, tts_engine, LiveTranscriber
+from services.tts import tts_service
+from services.audio_frontend import AudioFrontend
+from setups import FROM, message_collection, twilio_client, NGROK_URL, TTS_PRERENDER
+def prerender_phrases():
+    """Renders the stock phrases into the TTS cache on a short-lived loop."""
+    asyncio.run(tts_service.prerender())
+
+if TTS_PRERENDER:
+    threading.Thread(target=prerender_phrases, daemon=True).start()
 
 @app.route('/voice', methods=["POST", "GET"])
 def calling():
@@ -133,8 +240,9 @@ def calling():
     response.say('Code execution started. Handling the call now.')
     number = from_number if from_number != FROM else to_number
 
-    if call_id not in active_calls:
-        active_calls[call_id] = {"context": get_context(number, message_collection)}
+    if not sessions.get(call_id):
+        sessions.open(call_id, number=number, call_type=call_type, start_time=start_time,
+                      context=get_context(number, message_collection))
 
     ws_stream_url = f"wss://{request.host}/twilio-media-stream?call_id={call_id}&number={number}&start_time={start_time}&call_type={call_type}"
     print("Stream URL:" ,ws_stream_url)
@@ -145,6 +253,69 @@ def calling():
     
     return Response(str(response), content_type="application/xml")
 
+async def respond(ws, speaker, session, user_text, state):
+    """One AI turn: generates the reply and streams its audio to Twilio. Cancelled when the caller barges in."""
+    sent = False
+    try:
+        # Generate AI response and stream TTS audio
+        response_stream = await call(session, user_text, speaker)
+
+        if response_stream:
+            if isinstance(response_stream, bytes):
+                # Single chunk of audio
+                await ws.send(response_stream, binary=True)
+                sent = True
+            else:
+                # Stream multiple chunks
+                async for tts_chunk in response_stream:
+                    if tts_chunk:
+                        await ws.send(tts_chunk, binary=True)
+                        sent = True
+
+    except Exception as e:
+        print(f"Error processing utterance for call {session.call_id}: {e}")
+        # Send error message to user
+        error_audio = await tts_engine("Sorry, I encountered an error. Please try again.")
+        if error_audio:
+            await ws.send(error_audio, binary=True)
+            sent = True
+
+    if sent:
+        await send_mark(ws, state)
+
+async def send_mark(ws, state):
+    """Marks the end of the audio sent so far. Twilio echoes the mark once it has played everything before it."""
+    if not state["stream_sid"]:
+        return
+    state["mark_seq"] += 1
+    name = f"reply-{state['mark_seq']}"
+    state["marks"].add(name)
+    await ws.send(json.dumps({"event": "mark", "streamSid": state["stream_sid"], "mark": {"name": name}}))
+
+def is_replying(state):
+    """True while a reply is being generated, or Twilio still has some of its audio buffered to play."""
+    return bool((state["turn"] and not state["turn"].done()) or state["marks"])
+
+async def answer_utterances(ws, transcriber, speaker, state, session):
+    """Runs one AI turn per complete caller utterance, in order, for as long as the call lasts."""
+    while True:
+        user_text = await transcriber.utterances.get()
+        print(f"Call {session.call_id} - User said: {user_text}")
+
+        state["turn"] = asyncio.create_task(respond(ws, speaker, session, user_text, state))
+        await asyncio.wait([state["turn"]])  # Returns on cancellation too, unlike awaiting the task
+        state["turn"] = None
+
+async def barge_in(ws, speaker, state, call_id):
+    """Stops the reply in progress: cancels its LLM/TTS work and drops audio still queued at Twilio and Deepgram."""
+    if state["turn"] and not state["turn"].done():
+        state["turn"].cancel()
+        await speaker.clear()
+    if state["stream_sid"]:
+        await ws.send(json.dumps({"event": "clear", "streamSid": state["stream_sid"]}))
+    state["marks"].clear()  # Cleared audio never plays; Twilio returns its marks, which are ignored then
+    print(f"Call {call_id} - Caller interrupted, reply cancelled.")
+
 @sock.route('/twilio-media-stream')
 async def handle_twilio_media_stream(ws):
     """Handles WebSocket connection for Twilio Media Streams with proper async handling."""
@@ -152,7 +323,8 @@ async def handle_twilio_media_stream(ws):
     call_id = query_params.get("call_id", "")
     number = query_params.get("number", "")
     start_time = query_params.get("start_time", "")
-    call_type = query_params.get("call_type", None)
+    call_type = query_params.get("call_type") or None
+    call_type = None if call_type == "None" else call_type  # The stream URL formats a missing type as "None"
 
     print(f"New WebSocket connection for call {call_id}")
     
@@ -161,10 +333,33 @@ async def handle_twilio_media_stream(ws):
         await ws.close()
         return
 
-    # Get context from active calls or initialize if not present
-    context = active_calls.setdefault(call_id, {}).setdefault("context", get_context(number, message_collection))
+    # Session opened by /voice, or a new one if this worker hasn't seen the call (memory backend).
+    # The store and get_context block on MongoDB, so they run off the call's event loop.
+    session = await asyncio.to_thread(sessions.get, call_id)
+    if not session:
+        context = await asyncio.to_thread(get_context, number, message_collection)
+        session = await asyncio.to_thread(
+            sessions.open, call_id, number=number, call_type=call_type, start_time=start_time, context=context,
+        )
+
+    # One streaming STT session per call; the AI only runs on complete utterances
+    transcriber = LiveTranscriber()
+    frontend = AudioFrontend()  # Reorders frames, decodes μ-law and drops silence before STT
+    speaker = None              # TTS socket for the call; replies stream sentence by sentence
+    # Reply task in flight, Twilio stream id for "clear"/"mark", names of marks Twilio hasn't played up to yet
+    state = {"turn": None, "stream_sid": None, "marks": set(), "mark_seq": 0}
+    turns = None
     
     try:
+        opening = asyncio.create_task(tts_service.open_stream())  # Overlaps the STT handshake
+        try:
+            await transcriber.start()
+        finally:
+            speaker = await opening  # Held even if STT failed, so cleanup can close it
+        turns = asyncio.create_task(
+            answer_utterances(ws, transcriber, speaker, state, session)
+        )
+
         while True:
             data = await ws.receive()
             if not data:
@@ -177,38 +372,26 @@ async def handle_twilio_media_stream(ws):
                 print(f"Error decoding JSON for call {call_id}: {e}")
                 continue
 
-            if data_json.get("event") == "media":
-                try:
-                    # Process received audio payload (PCM format)
-                    audio_payload = data_json["media"]["payload"]
-                    raw_audio = base64.b64decode(audio_payload)
-                    
-                    # Use Deepgram to convert speech to text
-                    user_text = await stt_engine(raw_audio)
-                    print(f"Call {call_id} - User said: {user_text}")
-                    
-                    if not user_text or user_text.strip() == "":
-                        user_text = "no input"
-
-                    # Generate AI response and stream TTS audio
-                    response_stream = await call(call_id, number, start_time, context, user_text, call_type)
-                    
-                    if response_stream:
-                        if isinstance(response_stream, bytes):
-                            # Single chunk of audio
-                            await ws.send(response_stream, binary=True)
-                        else:
-                            # Stream multiple chunks
-                            async for tts_chunk in response_stream:
-                                if tts_chunk:
-                                    await ws.send(tts_chunk, binary=True)
-
-                except Exception as e:
-                    print(f"Error processing media for call {call_id}: {e}")
-                    # Send error message to user
-                    error_audio = await tts_engine("Sorry, I encountered an error. Please try again.")
-                    if error_audio:
-                        await ws.send(error_audio, binary=True)
+            if data_json.get("event") == "start":
+                state["stream_sid"] = data_json.get("streamSid") or data_json.get("start", {}).get("streamSid")
+
+            elif data_json.get("event") == "media":
+                audio_payload = data_json["media"]["payload"]
+                sequence = int(data_json.get("sequenceNumber", frontend.stats.received))
+                pcm, speech_started, speech_ended = frontend.feed(sequence, base64.b64decode(audio_payload))
+
+                # Caller talking over the reply (still generating, or still playing at Twilio): stop it and listen
+                if frontend.barge_in and is_replying(state):
+                    await barge_in(ws, speaker, state, call_id)
+
+                # Only voiced audio is streamed; Deepgram still decides where the utterance ends
+                if pcm:
+                    await transcriber.send(pcm)
+                if speech_ended:
+                    await transcriber.finalize()
+
+            elif data_json.get("event") == "mark":
+                state["marks"].discard(data_json.get("mark", {}).get("name"))  # Played up to this mark
 
             elif data_json.get("event") == "stop":
                 print(f"Call {call_id} ended normally. Cleaning up.")
@@ -219,7 +402,15 @@ async def handle_twilio_media_stream(ws):
 
     finally:
         try:
-            active_calls.pop(call_id, None)            
+            if state["turn"]:
+                state["turn"].cancel()
+            if turns:
+                turns.cancel()
+            if speaker:
+                await speaker.finish()
+            await transcriber.finish()
+            print(f"Call {call_id} audio stats: {frontend.stats.as_dict()}")
+            await asyncio.to_thread(sessions.end, call_id)  # Conversation history goes with the call
             await ws.close()
             print(f"WebSocket connection closed for call {call_id}")
 
@@ -257,8 +448,9 @@ def react():
 
 # ---------------------------- Scheduler for tasks
 # scheduler = BackgroundScheduler()
-# scheduler.add_job(func=fetch_email, trigger=IntervalTrigger(minutes=10))   # Fetch new emails every 10 minutes
+# scheduler.add_job(func=fetch_email, trigger=IntervalTrigger(minutes=10))   # Fetch new emails every 10 minutes (not needed with EMAIL_IDLE=true)
 # scheduler.add_job(func=get_health_data, trigger=CronTrigger(hour=23, minute=50))  # Fetch health data every day at 23:50
+# scheduler.add_job(func=lambda: fold_digest(datetime.now().strftime("%Y-%m-%d")), trigger=IntervalTrigger(minutes=30))  # Fold new items into the rolling digest
 # scheduler.add_job(func=daily_summary, trigger=CronTrigger(hour=23, minute=55))  # Generate daily summary every day at 23:55
 # scheduler.add_job(func=weekly_report, trigger=CronTrigger(day_of_week='sun', hour=23, minute=55))  # Generate weekly report every Sunday at 23:55
 # scheduler.start()
@@ -0,0 +1,38 @@
+"""
+Audio transcoding that runs inside the decode process pool. It is kept apart from services/dnt_vns.py
+on purpose: the pool is forked by start_decode_pool() at the top of ironman.py, before setups creates
+the MongoDB client or any other thread exists, so the workers inherit nothing but this module's imports.
+"""
+import io
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pydub import AudioSegment
+
+decode_pool = None  # Stays None unless started; callers then decode in-process
+
+
+def start_decode_pool(processes=None):
+    """
+    Forks the decode workers. Must run before any thread is started: forking copies only the calling
+    thread, so a fork taken after MongoDB's monitor threads exist can inherit locks held by them.
+    "spawn"/"forkserver" aren't an option, their children re-import ironman.py and start the whole app.
+    """
+    global decode_pool
+    if decode_pool is None:
+        processes = processes or int(os.getenv("MEDIA_DECODE_PROCESSES", 2))  # Read here, setups isn't imported yet
+        decode_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork"))
+        decode_pool.submit(int).result()  # With "fork" the first submit starts every worker process
+    return decode_pool
+
+
+def decode_to_pcm(audio_bytes, format="ogg", sample_rate=None):
+    """
+    Decodes OGG/Opus (or any ffmpeg format) to mono 16-bit PCM, resampled to `sample_rate` if given.
+    Returns (pcm_bytes, sample_rate).
+    """
+    audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format=format)  # Piped through ffmpeg, no temp files
+    audio = audio.set_channels(1).set_sample_width(2)
+    if sample_rate:
+        audio = audio.set_frame_rate(sample_rate)
+    return audio.raw_data, audio.frame_rate
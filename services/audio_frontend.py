@@ -0,0 +1,177 @@
+import numpy as np
+from collections import deque
+
+# ---------------------------- Audio front-end setup
+FRAME_BYTES = 160          # 20 ms of 8 kHz μ-law, the frame size Twilio sends
+MULAW_SILENCE = 0xFF       # μ-law code word for zero amplitude
+JITTER_SLOTS = 32          # Ring size (frames); a jump further ahead than this resyncs the buffer
+JITTER_DELAY = 3           # Newer frames that must arrive before a missing frame is concealed
+VAD_MIN_DB = -50.0         # Frames quieter than this (dBFS) are never speech
+VAD_MARGIN_DB = 12.0       # Speech must be this much louder than the tracked noise floor
+VAD_FLOOR_RISE_DB = 0.05   # Max noise-floor climb per voiced frame (2.5 dB/s), so steady noise stops counting as speech
+VAD_HANGOVER = 20          # Frames kept voiced after energy drops (400 ms): word endings + endpointing pause
+VAD_PREROLL = 10           # Silent frames replayed when speech starts (200 ms), so onsets aren't clipped
+BARGE_IN_FRAMES = 8        # Voiced frames (160 ms) before caller speech interrupts a reply; ignores clicks and coughs
+
+
+def _mulaw_table():
+    """ITU-T G.711 μ-law to 16-bit linear PCM for all 256 code words."""
+    codes = ~np.arange(256, dtype=np.uint8)
+    exponent = (codes >> 4) & 0x07
+    mantissa = (codes & 0x0F).astype(np.int32)
+    magnitude = ((mantissa << 3) + 0x84) << exponent
+    pcm = magnitude - 0x84
+    return np.where(codes & 0x80, -pcm, pcm).astype("<i2")
+
+
+MULAW_TO_PCM = _mulaw_table()
+SILENT_FRAME = bytes([MULAW_SILENCE]) * FRAME_BYTES
+
+
+def mulaw_to_pcm(data):
+    """Decodes μ-law bytes to a little-endian int16 array with one table lookup."""
+    return MULAW_TO_PCM[np.frombuffer(data, dtype=np.uint8)]
+
+
+class FrameStats:
+    """Per-call counters for the media stream."""
+
+    __slots__ = ("received", "duplicates", "late", "concealed", "voiced", "dropped", "speech_segments", "bytes_sent")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class JitterBuffer:
+    """
+    Puts Twilio media frames back in sequence-number order. Frames live in a ring of preallocated
+    bytearrays, so steady-state operation allocates nothing. An in-order frame is released at once; a
+    missing one is waited for until JITTER_DELAY newer frames have arrived, then concealed with silence.
+    """
+
+    def __init__(self, stats, slots=JITTER_SLOTS, delay=JITTER_DELAY):
+        self.stats = stats
+        self.delay = delay
+        self.frames = [bytearray(FRAME_BYTES) for _ in range(slots)]
+        self.lengths = [0] * slots
+        self.seqs = [-1] * slots
+        self.next_seq = None
+        self.highest = -1
+
+    def push(self, seq, payload):
+        self.stats.received += 1
+        if self.next_seq is None:
+            self.next_seq = seq
+        if seq < self.next_seq:
+            self.stats.late += 1  # Already released or concealed
+            return
+        if seq - self.next_seq >= len(self.frames):
+            self.stats.concealed += seq - self.next_seq  # Too far ahead: resync instead of waiting
+            self.seqs = [-1] * len(self.frames)
+            self.next_seq = seq
+
+        slot = seq % len(self.frames)
+        if self.seqs[slot] == seq:
+            self.stats.duplicates += 1
+            return
+        size = min(len(payload), FRAME_BYTES)
+        self.frames[slot][:size] = payload[:size]
+        self.lengths[slot] = size
+        self.seqs[slot] = seq
+        self.highest = max(self.highest, seq)
+
+    def pop_ready(self):
+        """Yields the frames that can be played out now, in order. Each view is only valid until the next push."""
+        while self.next_seq is not None and self.next_seq <= self.highest:
+            slot = self.next_seq % len(self.frames)
+            if self.seqs[slot] == self.next_seq:
+                yield memoryview(self.frames[slot])[:self.lengths[slot]]
+            elif self.highest - self.next_seq >= self.delay:
+                self.stats.concealed += 1
+                yield SILENT_FRAME
+            else:
+                return  # Give the missing frame a little longer
+            self.seqs[slot] = -1
+            self.next_seq += 1
+
+
+class EnergyVAD:
+    """
+    Frame-level voice activity from RMS energy against an adaptive noise floor. Frames within
+    VAD_HANGOVER of speech stay voiced so word endings and the pause endpointing needs reach STT.
+    The floor follows quiet frames quickly and creeps up by at most `floor_rise_db` per voiced frame:
+    short speech barely moves it, while steady noise louder than the initial floor (a car, a fan) is
+    eventually absorbed instead of keeping the VAD on for the rest of the call.
+    """
+
+    def __init__(self, min_db=VAD_MIN_DB, margin_db=VAD_MARGIN_DB, hangover=VAD_HANGOVER,
+                 floor_rise_db=VAD_FLOOR_RISE_DB):
+        self.min_db = min_db
+        self.margin_db = margin_db
+        self.hangover = hangover
+        self.floor_rise_db = floor_rise_db
+        self.noise_db = min_db - margin_db
+        self._hang = 0
+
+    def is_voiced(self, pcm):
+        rms = np.sqrt(np.mean(np.square(pcm, dtype=np.float64))) if len(pcm) else 0.0
+        level_db = 20 * np.log10(max(rms, 1.0) / 32768)
+
+        if level_db > max(self.min_db, self.noise_db + self.margin_db):
+            self.noise_db += min(self.floor_rise_db, 0.05 * (level_db - self.noise_db))
+            self._hang = self.hangover
+            return True
+        self.noise_db += 0.05 * (level_db - self.noise_db)
+        if self._hang:
+            self._hang -= 1
+            return True
+        return False
+
+
+class AudioFrontend:
+    """
+    Per-call media pipeline: jitter buffer -> μ-law decode -> VAD. Only voiced audio comes out, as 16-bit
+    PCM, together with speech start/end flags, so silence never reaches STT or the LLM.
+    """
+
+    def __init__(self):
+        self.stats = FrameStats()
+        self.buffer = JitterBuffer(self.stats)
+        self.vad = EnergyVAD()
+        self.speaking = False
+        self.speech_frames = 0  # Voiced frames in the current speech segment
+        self.barge_in = False   # Set by the feed() call in which the segment reached BARGE_IN_FRAMES
+        self._preroll = deque(maxlen=VAD_PREROLL)
+
+    def feed(self, seq, payload):
+        """Takes one Twilio media frame. Returns (voiced_pcm_bytes, speech_started, speech_ended)."""
+        self.buffer.push(seq, payload)
+        self.barge_in = False
+
+        voiced, started, ended = [], False, False
+        for frame in self.buffer.pop_ready():
+            pcm = mulaw_to_pcm(frame)
+            if self.vad.is_voiced(pcm):
+                if not self.speaking:
+                    self.speaking, started = True, True
+                    self.speech_frames = 0
+                    self.stats.speech_segments += 1
+                    voiced.extend(self._preroll)
+                    self._preroll.clear()
+                voiced.append(pcm)
+                self.speech_frames += 1
+                self.barge_in = self.barge_in or self.speech_frames == BARGE_IN_FRAMES
+                self.stats.voiced += 1
+            else:
+                if self.speaking:
+                    self.speaking, ended = False, True
+                self._preroll.append(pcm)
+                self.stats.dropped += 1
+
+        audio = np.concatenate(voiced).tobytes() if voiced else b""
+        self.stats.bytes_sent += len(audio)
+        return audio, started, ended
@@ -1,9 +1,12 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import json, dateparser,asyncio
-from setups import FROM, DEEPGRAM_API
-from deepgram import DeepgramClient, SpeakWebSocketEvents, SpeakWSOptions
+from setups import FROM, DEEPGRAM_API, CALLER_CONTEXT_DAYS, CALLER_CONTEXT_TOKENS, CALLER_CONTEXT_CACHE, CALLER_CONTEXT_REFRESH, \
+                   CALLER_CONTEXT_LAG
+from deepgram import DeepgramClient, DeepgramClientOptions, LiveOptions, LiveTranscriptionEvents
+from services.tts import tts_service
+from services.caller_context import CallerContextCache
 
-deepgram = DeepgramClient(DEEPGRAM_API)
+deepgram = DeepgramClient(DEEPGRAM_API, DeepgramClientOptions(options={"keepalive": "true"}))
 
 with open(r"prompts/check_intent.txt", 'r') as f:
     INTENT_PROMPT = f.read().strip()
@@ -11,11 +14,13 @@ with open(r"prompts/check_intent.txt", 'r') as f:
 with open(r"prompts/task_extraction.txt", 'r') as f:
     EXTRACTION_PROMPT = f.read().strip()
 
-def check_intent(conv_hist, call_id, LLM):
-    conversation_history = "\n".join([f"{entry['role']}: {entry['content']}" for entry in conv_hist.get(call_id, [])])
+with open(r"prompts/call_summary.txt", 'r') as f:
+    SUMMARY_PROMPT = f.read().strip()
+
+async def check_intent(conversation_history, LLM):
     prompt = INTENT_PROMPT.replace("{convo}", conversation_history)
 
-    response = LLM.invoke(prompt)
+    response = await LLM.ainvoke(prompt)
     try:
         result = json.loads(response.content)
         return result 
@@ -23,8 +28,7 @@ def check_intent(conv_hist, call_id, LLM):
         print(f"Error extracting intent: {e}")
         return None
     
-def extract_details(conv_hist, call_id, LLM, task=None):
-    conversation_history = "\n".join([f"{entry['role']}: {entry['content']}" for entry in conv_hist.get(call_id, [])])
+async def extract_details(conversation_history, LLM, task=None):
     task_details = ""
     if task:
         description = task.get("description", "")
@@ -40,7 +44,7 @@ def extract_details(conv_hist, call_id, LLM, task=None):
     extraction_prompt = extraction_prompt.replace("{convo}", conversation_history)
     extraction_prompt = extraction_prompt.replace("{task_details}", task_details)
 
-    response = LLM.invoke(extraction_prompt)
+    response = await LLM.ainvoke(extraction_prompt)
     try:
         extracted_details = json.loads(response.content)
         return extracted_details
@@ -61,16 +65,16 @@ def make_call(to_num, client, url, type=None):
         print("Error initializing call:", e)
         return {"error": "Call not initialized"}
 
-def get_context(number, collection):
-    last_week = datetime.now() - timedelta(days=7)
-    last_week = last_week.strftime("%Y-%m-%d %H:%M:%S")
+_context_caches = {}  # collection name -> CallerContextCache
 
-    messages = list(collection.find({
-        "sender": f"whatsapp:{number}",
-        "timestamp": {"$gte": last_week}
-    }))
-    context = '\n'.join([msg['message'] for msg in messages])
-    return context
+def get_context(number, collection):
+    cache = _context_caches.get(collection.full_name)
+    if cache is None:
+        cache = _context_caches.setdefault(collection.full_name, CallerContextCache(
+            collection, CALLER_CONTEXT_DAYS, CALLER_CONTEXT_TOKENS, CALLER_CONTEXT_CACHE, CALLER_CONTEXT_REFRESH,
+            CALLER_CONTEXT_LAG,
+        ))
+    return cache.get(number)
 
 def extract_time(text):
     try:
@@ -80,12 +84,10 @@ def extract_time(text):
         print(f"Error extracting time: {e}")
         return None
 
-def generate_call_summary(conversation, call_id, number, call_type, start_time, LLM):    
-    with open(r"prompts/call_summary.txt", 'r') as f:
-        prompt = f.read().strip()
-    prompt = prompt.replace("{convo}", conversation)
+async def generate_call_summary(conversation, call_id, number, call_type, start_time, LLM):    
+    prompt = SUMMARY_PROMPT.replace("{convo}", conversation)
 
-    response = LLM.invoke(prompt)
+    response = await LLM.ainvoke(prompt)
     try:
         summary_data = json.loads(response.content)
     except Exception as e:
@@ -100,61 +102,71 @@ def generate_call_summary(conversation, call_id, number, call_type, start_time,
     return summary_data
 
 async def tts_engine(text):
-    """Converts text to speech using Deepgram's TTS API."""
-    dg_connection = deepgram.speak.websocket.v('1')
-
-    options = SpeakWSOptions(
-        model="aura-luna-en",
-        encoding='linear16',
-        sample_rate=8000
-    )
-
-    audio_data = []
-    
-    def on_binary_data(self, data, **kwargs):
-        audio_data.append(data)
-        
-    dg_connection.on(SpeakWebSocketEvents.AudioData, on_binary_data)
-
-    if not dg_connection.start(options):
-        print("[ERROR] Failed to start Deepgram WebSocket connection.")
-        return None
-
-    dg_connection.send_text(text)
-    dg_connection.flush()
-    await dg_connection.wait_for_event(SpeakWebSocketEvents.Close)
-    dg_connection.finish()
-
-    tts_audio = b''.join(audio_data)
-    return tts_audio
-
-async def stt_engine(pcm_audio):
-    """Transcribe PCM audio using Deepgram's WebSocket API."""
-    try:
-        deepgram_live = await deepgram.transcription.live({
-            'encoding': 'linear16',
-            'sample_rate': 8000,
-            'channels': 1,
-            'interim_results': True,
-            'punctuate': True,
-        })
-
-        transcript = ""
-        async def get_transcript():
-            nonlocal transcript
-            async for result in deepgram_live:
-                if "channel" in result:
-                    transcript = result["channel"]["alternatives"][0]["transcript"]
-        
-        # Wait for both sending and receiving
-        await asyncio.gather(
-            deepgram_live.send(pcm_audio),
-            get_transcript()
+    """Converts text to speech using Deepgram's TTS API. Served from the phrase cache when possible."""
+    return await tts_service.synthesize(text)
+
+class LiveTranscriber:
+    """
+    One Deepgram live session for the whole call. Audio frames are forwarded as they arrive; final segments
+    are collected until Deepgram reports the end of the utterance (endpointing sets `speech_final`, or an
+    UtteranceEnd event arrives), and the complete utterance is put on `utterances`.
+    """
+
+    def __init__(self, encoding="linear16", sample_rate=8000):
+        self.options = LiveOptions(
+            model="nova-2",
+            language="en-US",
+            encoding=encoding,
+            sample_rate=sample_rate,
+            channels=1,
+            punctuate=True,
+            smart_format=True,
+            interim_results=True,   # Required for utterance_end_ms
+            endpointing=300,        # Milliseconds of silence that finalize speech
+            utterance_end_ms="1000",
+            vad_events=True,
         )
-        return transcript
-    except Exception as e:
-        print(f"Deepgram Error: {e}")
-        return ""
+        self.utterances = asyncio.Queue()
+        self._segments = []
+        self._connection = None
+
+    async def start(self):
+        self._connection = deepgram.listen.asyncwebsocket.v("1")
+        self._connection.on(LiveTranscriptionEvents.Transcript, self._on_transcript)
+        self._connection.on(LiveTranscriptionEvents.UtteranceEnd, self._on_utterance_end)
+        self._connection.on(LiveTranscriptionEvents.Error, self._on_error)
+        if await self._connection.start(self.options) is False:
+            raise ConnectionError("Failed to start Deepgram live transcription")
+
+    async def send(self, audio):
+        await self._connection.send(audio)
+
+    async def finalize(self):
+        """Asks Deepgram to finalize what it has heard so far, e.g. when local VAD saw the caller stop."""
+        await self._connection.finalize()
+
+    async def finish(self):
+        if self._connection is not None:
+            await self._connection.finish()
+            self._connection = None
+
+    async def _on_transcript(self, client, result, **kwargs):
+        text = result.channel.alternatives[0].transcript.strip()
+        if result.is_final and text:
+            self._segments.append(text)
+        if result.speech_final or result.from_finalize:
+            self._end_utterance()
+
+    async def _on_utterance_end(self, client, utterance_end, **kwargs):
+        self._end_utterance()  # Fallback when noise kept endpointing from firing
+
+    async def _on_error(self, client, error, **kwargs):
+        print(f"Deepgram Error: {error}")
+
+    def _end_utterance(self):
+        if self._segments:
+            self.utterances.put_nowait(" ".join(self._segments))
+            self._segments = []
 
 
 # def tts_engine(text, client):
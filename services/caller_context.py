@@ -0,0 +1,91 @@
+import bisect
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from ai_models.tokens import estimate_tokens
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"  # How WhatsApp message timestamps are stored
+
+
+class _CallerEntry:
+    __slots__ = ("messages", "tokens", "last", "seen", "refreshed_at", "lock")
+
+    def __init__(self):
+        self.messages = []         # (timestamp, text, tokens), sorted by timestamp
+        self.tokens = 0
+        self.last = None           # Newest timestamp seen
+        self.seen = {}             # _id -> timestamp of every message read inside the overlap window
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+
+class CallerContextCache:
+    """
+    Recent WhatsApp messages per caller number, joined into the context the call prompts use.
+    A refresh only reads messages from `lag` before the newest one seen (projecting `message` and
+    `timestamp`): timestamps are set when a message arrives but it is stored after classification, by
+    several workers, so a message can land after newer ones were read. Ids in that overlap are remembered,
+    so nothing is added twice. Messages older than `days` are dropped, and the oldest are trimmed until the
+    context fits `token_budget`.
+    """
+
+    def __init__(self, collection, days=7, token_budget=2000, max_callers=256, refresh_seconds=30, lag_seconds=1800):
+        self.collection = collection
+        self.window = timedelta(days=days)
+        self.token_budget = token_budget
+        self.max_callers = max_callers
+        self.refresh_interval = timedelta(seconds=refresh_seconds)
+        self.lag = timedelta(seconds=lag_seconds)
+
+        self._entries = OrderedDict()  # number -> _CallerEntry, least recently used first
+        self._lock = threading.Lock()  # Guards the LRU only; Mongo is read under the entry's own lock
+
+    def _entry(self, number):
+        with self._lock:
+            entry = self._entries.pop(number, None) or _CallerEntry()
+            self._entries[number] = entry
+            while len(self._entries) > self.max_callers:
+                self._entries.popitem(last=False)
+            return entry
+
+    def _refresh(self, number, entry, now):
+        oldest = (now - self.window).strftime(TIME_FORMAT)
+        since = oldest
+        if entry.last:
+            overlap = (datetime.strptime(entry.last, TIME_FORMAT) - self.lag).strftime(TIME_FORMAT)
+            since = max(since, overlap)
+            entry.seen = {_id: ts for _id, ts in entry.seen.items() if ts >= since}
+
+        cursor = self.collection.find(
+            {"sender": f"whatsapp:{number}", "timestamp": {"$gte": since}},
+            {"message": 1, "timestamp": 1},  # Index (sender, timestamp) covers the filter and sort
+        ).sort("timestamp", 1)
+
+        for doc in cursor:
+            if doc["_id"] in entry.seen:
+                continue
+            entry.seen[doc["_id"]] = doc["timestamp"]
+            entry.last = max(entry.last or doc["timestamp"], doc["timestamp"])
+
+            text = doc.get("message") or ""
+            tokens = estimate_tokens(text)
+            bisect.insort(entry.messages, (doc["timestamp"], text, tokens), key=lambda message: message[0])
+            entry.tokens += tokens
+
+        # Slide the window, then trim to the token budget from the oldest end
+        drop = 0
+        while drop < len(entry.messages) and (entry.messages[drop][0] < oldest or entry.tokens > self.token_budget):
+            entry.tokens -= entry.messages[drop][2]
+            drop += 1
+        del entry.messages[:drop]
+        entry.refreshed_at = now
+
+    def get(self, number):
+        """Returns the caller's recent messages joined by newlines, refreshed if the entry is stale."""
+        entry = self._entry(number)
+        with entry.lock:
+            now = datetime.now()
+            if entry.refreshed_at is None or now - entry.refreshed_at >= self.refresh_interval:
+                self._refresh(number, entry, now)
+            return "\n".join(text for _, text, _ in entry.messages)
@@ -1,49 +1,227 @@
+import io
+import json
+import time
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import requests
-from pydub import AudioSegment
+from requests.adapters import HTTPAdapter
 import speech_recognition as sr
 
-from setups import account_sid, auth_token
+from setups import account_sid, auth_token, STT_BACKEND, VOSK_MODEL_PATH, STT_THREADS
+from services import audio_codec
+from services.audio_codec import decode_to_pcm
 
-# ---------------------------- Download VNs and transcribe them
-def download_media(media_url, file_path):
-    from requests.auth import HTTPBasicAuth
+# ---------------------------- Media download setup
+CHUNK_SIZE = 64 * 1024               # Bytes read per streamed chunk
+MAX_MEDIA_BYTES = 16 * 1024 * 1024   # WhatsApp's media size limit
+
+# One pooled session, so downloads reuse keep-alive connections to Twilio
+session = requests.Session()
+session.auth = (account_sid, auth_token)
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# ---------------------------- Download and decode VNs
+def download_media(media_url):
+    """Streams a Twilio media file into memory. Returns a BytesIO, or None if the download failed."""
     try:
-        response = requests.get(media_url, auth=HTTPBasicAuth(account_sid, auth_token), timeout=10)
-        response.raise_for_status() 
-        with open(file_path, "wb") as f:
-            f.write(response.content)
-        print(f"Downloaded media: {file_path}")
-        return True
-    except requests.exceptions.RequestException as e:
+        buffer = io.BytesIO()
+        with session.get(media_url, stream=True, timeout=10) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                buffer.write(chunk)
+                if buffer.tell() > MAX_MEDIA_BYTES:
+                    raise ValueError(f"media larger than {MAX_MEDIA_BYTES} bytes")
+
+        print(f"Downloaded media: {media_url} ({buffer.tell()} bytes)")
+        buffer.seek(0)
+        return buffer
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"Failed to download media: {e}")
-        return False
+        return None
 
 
-def transcribe_audio(file_path):
-    try:
-        wav_file_path = file_path.with_suffix(".wav")
-        audio = AudioSegment.from_file(file_path, format="ogg")
-        audio.export(wav_file_path, format="wav")
+def decode_many(audio_files, format="ogg", sample_rate=None):
+    """
+    Transcodes several notes at once across the process pool, so ffmpeg output handling doesn't hold the
+    GIL. Returns (pcm_bytes, sample_rate) per note, or the exception when that note couldn't be decoded.
+    """
+    decode_pool = audio_codec.decode_pool  # Forked at startup by ironman.py (None elsewhere)
+    payloads = [audio_file.getvalue() if isinstance(audio_file, io.BytesIO) else audio_file for audio_file in audio_files]
+    results = [None] * len(payloads)
 
-        recognizer = sr.Recognizer()
+    if decode_pool is not None:
+        try:
+            futures = [decode_pool.submit(decode_to_pcm, data, format, sample_rate) for data in payloads]
+            for i, future in enumerate(futures):
+                try:
+                    results[i] = future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    results[i] = e
+            return results
+        except BrokenProcessPool:
+            print("Audio decode pool broke, decoding in-process from now on.")
+            audio_codec.decode_pool = None  # Re-forking now would copy the app's running threads
 
-        # Load audio file
-        with sr.AudioFile(str(wav_file_path)) as source:
-            audio_data = recognizer.record(source)
+    for i, data in enumerate(payloads):
+        try:
+            results[i] = decode_to_pcm(data, format, sample_rate)
+        except Exception as e:
+            results[i] = e
+    return results
 
-        # Use Google Web Speech API (No API key required)
-        transcribed_text = recognizer.recognize_google(audio_data)
 
-        # Delete the files after processing
-        file_path.unlink()
-        wav_file_path.unlink()
+def decode_audio(audio_file, format="ogg", sample_rate=None):
+    """Transcodes one note. Returns (pcm_bytes, sample_rate)."""
+    result = decode_many([audio_file], format, sample_rate)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
 
-        return transcribed_text.strip()
+# ---------------------------- Speech-to-text backends
+class STTBackend(ABC):
+    """
+    A speech-to-text engine. `transcribe` takes mono 16-bit PCM and returns the text ("" when nothing was
+    recognized). `transcribe_batch` runs a list of clips on a shared thread pool, which suits both network
+    engines and local engines whose native code releases the GIL.
+    """
 
-    except sr.UnknownValueError:
-        return "Could not understand audio"
-    except sr.RequestError:
-        return "API request failed"
+    name = "base"
+    sample_rate = None  # Rate the engine wants its PCM in; None keeps the source rate
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=STT_THREADS, thread_name_prefix=f"stt-{self.name}")
+
+    def warm_up(self):
+        """Runs one tiny inference so the first real note doesn't pay for lazy initialization."""
+        rate = self.sample_rate or 16000
+        self.transcribe(b"\0\0" * (rate // 2), rate)  # Half a second of silence
+
+    @abstractmethod
+    def transcribe(self, pcm, sample_rate):
+        ...
+
+    def transcribe_batch(self, clips):
+        """Transcribes [(pcm, sample_rate), ...]. Failed clips come back as the exception instead of text."""
+        def run(clip):
+            try:
+                return self.transcribe(*clip)
+            except Exception as e:
+                return e
+        return list(self.executor.map(run, clips))
+
+
+class GoogleSTT(STTBackend):
+    """Google Web Speech API through speech_recognition. No API key, one network round-trip per note."""
+
+    name = "google"
+
+    def __init__(self):
+        super().__init__()
+        self.recognizer = sr.Recognizer()
+
+    def warm_up(self):
+        pass  # Nothing to load, and a silent request would only cost a round-trip
+
+    def transcribe(self, pcm, sample_rate):
+        try:
+            return self.recognizer.recognize_google(sr.AudioData(pcm, sample_rate, 2)).strip()
+        except sr.UnknownValueError:
+            return ""
+
+
+class VoskSTT(STTBackend):
+    """Local CPU recognition with a Vosk (Kaldi) model. The model is loaded once and shared by every recognizer."""
+
+    name = "vosk"
+    sample_rate = 16000
+    FEED_BYTES = 8000  # PCM fed per AcceptWaveform call (0.25s at 16 kHz)
+
+    def __init__(self, model_path):
+        try:
+            from vosk import Model, KaldiRecognizer, SetLogLevel  # Optional, only imported for STT_BACKEND=vosk
+        except ImportError as e:
+            raise ImportError("vosk is not installed: pip install -r requirements-optional.txt") from e
+
+        SetLogLevel(-1)
+        started = time.perf_counter()
+        self.model = Model(model_path)
+        self._recognizer = KaldiRecognizer
+        print(f"Vosk model loaded from {model_path} in {time.perf_counter() - started:.1f}s.")
+        super().__init__()
+
+    def transcribe(self, pcm, sample_rate):
+        recognizer = self._recognizer(self.model, sample_rate)  # Recognizers are cheap, the model is not
+        texts = []
+        for i in range(0, len(pcm), self.FEED_BYTES):
+            if recognizer.AcceptWaveform(pcm[i:i + self.FEED_BYTES]):
+                texts.append(json.loads(recognizer.Result()).get("text", ""))  # Collect each finished utterance
+        texts.append(json.loads(recognizer.FinalResult()).get("text", ""))
+        return " ".join(text for text in texts if text).strip()
+
+
+def load_backend(name):
+    """Builds an STT backend by name ("google" or "vosk")."""
+    if name == "vosk":
+        if not VOSK_MODEL_PATH:
+            raise ValueError("STT_BACKEND=vosk needs VOSK_MODEL_PATH. Check your .env file.")
+        return VoskSTT(VOSK_MODEL_PATH)
+    if name == "google":
+        return GoogleSTT()
+    raise ValueError(f"Unknown STT backend: {name}")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_stt_backend():
+    """Returns the configured backend, loading it on first use. Falls back to Google if it can't be loaded."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            try:
+                _backend = load_backend(STT_BACKEND)
+            except Exception as e:
+                print(f"Could not load STT backend '{STT_BACKEND}': {e}. Falling back to Google.")
+                _backend = GoogleSTT()
+        return _backend
+
+
+def warm_up_stt():
+    """Loads and warms the configured backend. Called once at startup."""
+    backend = get_stt_backend()
+    started = time.perf_counter()
+    try:
+        backend.warm_up()
+        print(f"STT backend '{backend.name}' warm in {time.perf_counter() - started:.2f}s.")
     except Exception as e:
-        print(f"Error transcribing audio: {e}")
+        print(f"STT warm-up failed: {e}")
+
+# ---------------------------- Transcription
+def _describe(result):
+    """Maps a backend result to the text stored for the note."""
+    if isinstance(result, sr.RequestError):
+        return "API request failed"
+    if isinstance(result, Exception):
+        print(f"Error transcribing audio: {result}")
         return "Transcription error"
+    return result or "Could not understand audio"
+
+
+def transcribe_batch(audio_files):
+    """Transcribes in-memory voice notes. All of them are decoded at once, then run as one backend batch."""
+    backend = get_stt_backend()
+    results = decode_many(audio_files, sample_rate=backend.sample_rate)
+
+    decoded = [i for i, result in enumerate(results) if not isinstance(result, Exception)]
+    for i, text in zip(decoded, backend.transcribe_batch([results[i] for i in decoded])):
+        results[i] = text
+    return [_describe(result) for result in results]
+
+
+def transcribe_audio(audio_file):
+    return transcribe_batch([audio_file])[0]
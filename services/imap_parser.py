@@ -0,0 +1,135 @@
+import re
+import base64
+import binascii
+import quopri
+
+# ---------------------------- FETCH response grouping
+_RECORD_START = re.compile(rb"^\d+ \(")
+_UID = re.compile(rb"UID (\d+)")
+
+
+def group_fetch_response(data):
+    """
+    Groups the raw list imaplib returns for a multi-message FETCH into one record per message:
+    {"uid": int, "meta": bytes (everything outside literals), "literal": bytes or None}.
+    """
+    records = []
+    for item in data:
+        if isinstance(item, tuple):
+            meta, literal = item[0], item[1]
+            if records and not _RECORD_START.match(meta):
+                records[-1]["meta"] += b" " + meta  # Second literal of the same message
+                continue
+            records.append({"meta": meta, "literal": literal})
+        elif isinstance(item, bytes) and item.strip():
+            if _RECORD_START.match(item) or not records:
+                records.append({"meta": item, "literal": None})
+            else:
+                records[-1]["meta"] += item  # Trailing items after a literal, e.g. b' BODYSTRUCTURE (...))'
+
+    for record in records:
+        match = _UID.search(record["meta"])
+        record["uid"] = int(match.group(1)) if match else None
+    return [record for record in records if record["uid"] is not None]
+
+
+# ---------------------------- BODYSTRUCTURE parsing
+_TOKEN = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}|[^\s()"]+')
+
+
+def _parse_tokens(tokens, pos):
+    """Parses one parenthesized list starting after its "(" and returns (items, next position)."""
+    items = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        if token == b"(":
+            child, pos = _parse_tokens(tokens, pos + 1)
+            items.append(child)
+            continue
+        if token == b")":
+            return items, pos + 1
+        if token.startswith(b"{"):
+            raise ValueError("Literals inside BODYSTRUCTURE are not supported")
+        if token.startswith(b'"'):
+            items.append(re.sub(rb'\\(.)', rb"\1", token[1:-1]).decode(errors="ignore"))
+        elif token.upper() == b"NIL":
+            items.append(None)
+        else:
+            items.append(token.decode(errors="ignore"))
+        pos += 1
+    raise ValueError("Unbalanced BODYSTRUCTURE")
+
+
+def parse_bodystructure(meta):
+    """Extracts the BODYSTRUCTURE from a FETCH record as nested lists, or None if it can't be parsed."""
+    start = meta.find(b"BODYSTRUCTURE (")
+    if start == -1:
+        return None
+    tokens = _TOKEN.findall(meta[start + len(b"BODYSTRUCTURE ("):])
+    try:
+        structure, _ = _parse_tokens(tokens, 0)
+    except ValueError:
+        return None
+    return structure
+
+
+def _part_info(node, spec):
+    params = node[2] if isinstance(node[2], list) else []
+    params = {str(params[i]).lower(): params[i + 1] for i in range(0, len(params) - 1, 2)}
+    try:
+        size = int(node[6])
+    except (IndexError, TypeError, ValueError):
+        size = 0
+    return {
+        "part": spec,
+        "type": f"{str(node[0]).lower()}/{str(node[1]).lower()}",
+        "charset": params.get("charset") or "utf-8",
+        "encoding": str(node[5] or "7bit").lower(),
+        "size": size,
+    }
+
+
+def find_text_part(structure, spec=""):
+    """
+    Returns the section spec and encoding of the first text/plain part (depth-first, like msg.walk()).
+    A single-part message is always part "1", whatever its type. Attached messages are not searched.
+    """
+    if not structure:
+        return None
+
+    if not isinstance(structure[0], list):  # Single part
+        if not spec:
+            return _part_info(structure, "1")
+        info = _part_info(structure, spec)
+        return info if info["type"] == "text/plain" else None
+
+    # Children come first; the subtype and extension data (which may hold lists too) follow them
+    for i, child in enumerate(structure):
+        if not isinstance(child, list):
+            break
+        found = find_text_part(child, f"{spec}.{i + 1}" if spec else str(i + 1))
+        if found:
+            return found
+    return None
+
+
+# ---------------------------- Body decoding
+def decode_body(payload, encoding, charset):
+    """Decodes a (possibly truncated) body section according to its transfer encoding and charset."""
+    if payload is None:
+        return ""
+
+    if encoding == "base64":
+        data = re.sub(rb"\s+", b"", payload)
+        data = data[:len(data) - len(data) % 4]  # Drop a partial quantum left by the size cap
+        try:
+            payload = base64.b64decode(data)
+        except binascii.Error:
+            return ""
+    elif encoding == "quoted-printable":
+        payload = quopri.decodestring(payload)
+
+    try:
+        return payload.decode(charset, errors="ignore")
+    except LookupError:
+        return payload.decode("utf-8", errors="ignore")
@@ -0,0 +1,84 @@
+"""
+Compares speech-to-text backends on real voice notes.
+
+    python -m services.stt_benchmark notes/*.ogg
+    python -m services.stt_benchmark notes/*.ogg --backends google vosk --repeat 3
+
+For each backend it reports load/warm-up time, per-note latency when notes are recognized one at a
+time (the old transcribe_audio path), and throughput when the same notes go through transcribe_batch.
+Decoding is done once up front so only recognition is measured.
+"""
+import time
+import argparse
+import statistics
+
+from services.audio_codec import decode_to_pcm
+from services.dnt_vns import load_backend
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def benchmark(backend_name, notes, repeat=1):
+    """Runs one backend over the notes (raw file bytes). Returns a dict of timings."""
+    started = time.perf_counter()
+    backend = load_backend(backend_name)
+    backend.warm_up()
+    load_seconds = time.perf_counter() - started
+
+    clips = [decode_to_pcm(data, sample_rate=backend.sample_rate) for data in notes]
+    audio_seconds = sum(len(pcm) / 2 / rate for pcm, rate in clips) * repeat
+
+    latencies = []
+    for _ in range(repeat):
+        for pcm, rate in clips:
+            started = time.perf_counter()
+            backend.transcribe(pcm, rate)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        backend.transcribe_batch(clips)
+    batch_seconds = time.perf_counter() - started
+
+    return {
+        "backend": backend_name,
+        "load": load_seconds,
+        "p50": _percentile(latencies, 50),
+        "p95": _percentile(latencies, 95),
+        "mean": statistics.mean(latencies),
+        "sequential_rate": len(latencies) / sum(latencies),
+        "batch_rate": len(latencies) / batch_seconds,
+        "realtime": audio_seconds / batch_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark speech-to-text backends on voice notes.")
+    parser.add_argument("files", nargs="+", help="Voice notes (any format ffmpeg can read)")
+    parser.add_argument("--backends", nargs="+", default=["google", "vosk"])
+    parser.add_argument("--repeat", type=int, default=1, help="Passes over the notes per backend")
+    args = parser.parse_args()
+
+    notes = []
+    for path in args.files:
+        with open(path, "rb") as f:
+            notes.append(f.read())
+
+    print(f"{'backend':<8} {'load s':>7} {'p50 s':>7} {'p95 s':>7} {'mean s':>7} {'seq/s':>7} {'batch/s':>8} {'x realtime':>10}")
+    for name in args.backends:
+        try:
+            r = benchmark(name, notes, args.repeat)
+        except Exception as e:
+            print(f"{name:<8} skipped: {e}")
+            continue
+        print(
+            f"{r['backend']:<8} {r['load']:>7.2f} {r['p50']:>7.2f} {r['p95']:>7.2f} {r['mean']:>7.2f} "
+            f"{r['sequential_rate']:>7.2f} {r['batch_rate']:>8.2f} {r['realtime']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
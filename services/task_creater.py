@@ -2,7 +2,7 @@ import uuid
 
 def create_task(task_details, identifier):
     """Creates task with a unique task_id."""
-    task_id = str(uuid.uuid4)
+    task_id = str(uuid.uuid4())
     task_data = {
         "task_id": task_id,
         **identifier,
@@ -0,0 +1,280 @@
+import os
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from deepgram import DeepgramClient, SpeakWebSocketEvents, SpeakWSOptions
+
+from setups import (
+    DEEPGRAM_API, TTS_VOICE, TTS_SAMPLE_RATE, TTS_CACHE_DIR, TTS_CACHE_ENTRIES, TTS_DISK_ENTRIES
+)
+
+deepgram = DeepgramClient(DEEPGRAM_API)
+
+with open(r"prompts/stock_phrases.txt", 'r') as f:
+    STOCK_PHRASES = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+# ---------------------------- Streaming synthesis
+FLUSH_TIMEOUT = 10  # Seconds pending sentences may go without audio or a Flushed event before the socket is dropped
+PRERENDER_CONCURRENCY = 2  # Stock phrases synthesized at once when pre-rendering
+
+
+class SpeechStream:
+    """
+    One Deepgram speak websocket for the whole call. Each sentence is sent and flushed as soon as it is
+    ready, so synthesis of the next sentence overlaps playback of the current one, and audio chunks are
+    yielded the moment Deepgram returns them.
+    """
+
+    _FLUSHED = object()
+    _DONE = object()
+
+    def __init__(self, model=TTS_VOICE, sample_rate=TTS_SAMPLE_RATE):
+        self.options = SpeakWSOptions(model=model, encoding="linear16", sample_rate=sample_rate)
+        self._connection = None
+        self._audio = asyncio.Queue()
+        self._discarding = False  # Set by clear() until Deepgram confirms, so stale audio is dropped
+        self._drained = True      # False while a speak() is unfinished
+
+    async def start(self):
+        connection = deepgram.speak.asyncwebsocket.v("1")
+        connection.on(SpeakWebSocketEvents.AudioData, self._on_audio)
+        connection.on(SpeakWebSocketEvents.Flushed, self._on_flushed)
+        connection.on(SpeakWebSocketEvents.Cleared, self._on_cleared)
+        connection.on(SpeakWebSocketEvents.Error, self._on_error)
+        connection.on(SpeakWebSocketEvents.Close, self._on_close)
+        if await connection.start(self.options) is False:
+            raise ConnectionError("Failed to start Deepgram speak connection")
+        self._connection = connection
+
+    async def finish(self):
+        if self._connection is not None:
+            await self._connection.finish()
+            self._connection = None
+
+    async def _reset(self):
+        """Drops a connection that failed mid-turn; the next speak() opens a fresh one."""
+        connection, self._connection = self._connection, None
+        self._audio = asyncio.Queue()
+        self._drained, self._discarding = True, False
+        if connection is not None:
+            try:
+                await connection.finish()
+            except Exception:
+                pass
+
+    async def clear(self):
+        """Drops everything queued or being synthesized, e.g. when the caller interrupts."""
+        self._audio = asyncio.Queue()
+        if self._connection is not None and await self._connection.is_connected():
+            self._discarding = True
+            await self._connection.clear()
+
+    async def speak(self, sentences):
+        """Synthesizes an async iterable of sentences. Yields linear16 audio chunks as they arrive."""
+        if self._connection is None or not await self._connection.is_connected():
+            self._audio = asyncio.Queue()  # Nothing from the old socket may leak into this turn
+            await self.start()  # Deepgram closes idle speak sockets; reopen between turns if needed
+
+        async def send_all():
+            try:
+                async for sentence in sentences:
+                    await self._connection.send_text(sentence)
+                    audio.put_nowait(sentence)  # Counts one pending flush, queued ahead of its Flushed event
+                    await self._connection.flush()
+            except Exception as e:
+                audio.put_nowait(e)
+            finally:
+                audio.put_nowait(self._DONE)
+
+        audio = self._audio  # clear() swaps the queue; this turn keeps reading its own
+        sender = asyncio.create_task(send_all())
+        pending, done = 0, False
+        self._drained = False
+        try:
+            while not (done and pending == 0):
+                if pending:
+                    # Sentences sent to Deepgram must make progress (waiting on the LLM for the next one needn't)
+                    try:
+                        item = await asyncio.wait_for(audio.get(), FLUSH_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        raise TimeoutError(f"No TTS audio for {FLUSH_TIMEOUT}s with {pending} sentence(s) pending")
+                else:
+                    item = await audio.get()
+
+                if item is self._DONE:
+                    done = True
+                elif item is self._FLUSHED:
+                    pending -= 1
+                elif isinstance(item, str):
+                    pending += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+            self._drained = True
+        except Exception:
+            await self._reset()
+            raise
+        finally:
+            sender.cancel()
+
+    async def _on_audio(self, client, data, **kwargs):
+        if not self._discarding:
+            self._audio.put_nowait(data)
+
+    async def _on_flushed(self, client, flushed, **kwargs):
+        if not self._discarding:
+            self._audio.put_nowait(self._FLUSHED)
+
+    async def _on_cleared(self, client, cleared, **kwargs):
+        self._discarding = False
+
+    async def _on_error(self, client, error, **kwargs):
+        print(f"Deepgram TTS Error: {error}")
+        self._fail(ConnectionError(f"Deepgram TTS error: {error}"))
+
+    async def _on_close(self, client, close=None, **kwargs):
+        self._fail(ConnectionError("Deepgram speak connection closed"))
+
+    def _fail(self, error):
+        """Wakes a turn waiting on this connection with the error, instead of leaving it hanging."""
+        if not self._drained:
+            self._audio.put_nowait(error)
+
+
+# ---------------------------- Phrase audio cache
+def cache_key(voice, sample_rate, text):
+    return hashlib.sha256(f"{voice}|{sample_rate}|{text}".encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """
+    Synthesized phrases as ready linear16 PCM: an in-memory LRU in front of a directory of .pcm files.
+    Disk hits are promoted to memory; the disk tier keeps its newest `disk_entries` files. Calls on
+    different loops and the pre-render thread share one cache, so the memory tier is lock-protected.
+    """
+
+    def __init__(self, directory, max_entries=256, disk_entries=2000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.disk_entries = disk_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()  # One eviction scan at a time
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pcm")
+
+    def get(self, key):
+        with self._lock:
+            audio = self.entries.get(key)
+            if audio is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return audio
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path)  # Recency for disk eviction
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._remember(key, audio)
+        return audio
+
+    def put(self, key, audio):
+        with self._lock:
+            self._remember(key, audio)
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"  # Concurrent writers of one phrase don't share a temp file
+        try:
+            with open(tmp, "wb") as f:
+                f.write(audio)
+            os.replace(tmp, path)  # Readers never see a partial file
+            self._evict_disk()
+        except OSError as e:
+            print(f"TTS cache write failed: {e}")
+
+    def _remember(self, key, audio):
+        self.entries[key] = audio
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _evict_disk(self):
+        with self._disk_lock:
+            files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".pcm")]
+            if len(files) <= self.disk_entries:
+                return
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in files[:len(files) - self.disk_entries]:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+# ---------------------------- TTS service
+async def _single(text):
+    yield text
+
+
+class TTSService:
+    """
+    Text-to-speech for calls, with one-off phrases cached as ready PCM. Deepgram's async sockets belong
+    to the event loop that opened them, and every call runs on its own short-lived loop, so connections
+    aren't shared: each call opens its own speaker, and a phrase missing from the cache gets a one-off socket.
+    """
+
+    def __init__(self, voice=TTS_VOICE, sample_rate=TTS_SAMPLE_RATE):
+        self.voice = voice
+        self.sample_rate = sample_rate
+        self.cache = AudioCache(TTS_CACHE_DIR, TTS_CACHE_ENTRIES, TTS_DISK_ENTRIES)
+
+    async def open_stream(self):
+        """Opens a speak connection on the running loop. The caller must finish() it before the loop ends."""
+        speaker = SpeechStream(self.voice, self.sample_rate)
+        await speaker.start()
+        return speaker
+
+    async def synthesize(self, text):
+        """Returns the linear16 PCM for one phrase, from the cache or a one-off connection."""
+        key = cache_key(self.voice, self.sample_rate, text)
+        audio = self.cache.get(key)
+        if audio is None:
+            speaker = await self.open_stream()
+            try:
+                audio = b"".join([chunk async for chunk in speaker.speak(_single(text))])
+            finally:
+                await speaker.finish()
+            if audio:
+                self.cache.put(key, audio)
+        return audio
+
+    async def prerender(self, phrases=None):
+        """Synthesizes the stock phrases that aren't cached yet, a few at a time."""
+        phrases = [text for text in (phrases or STOCK_PHRASES)
+                   if self.cache.get(cache_key(self.voice, self.sample_rate, text)) is None]
+        limit = asyncio.Semaphore(PRERENDER_CONCURRENCY)
+
+        async def render(text):
+            async with limit:
+                await self.synthesize(text)
+
+        await asyncio.gather(*(render(text) for text in phrases), return_exceptions=True)
+        print(f"Pre-rendered {len(phrases)} stock phrases. TTS cache: {self.cache.stats()}")
+
+
+tts_service = TTSService()
@@ -39,6 +39,20 @@ insight_collection = db['insights']
 call_collection = db['calls']
 daily_sum_collection = db['daily_summary']
 weekly_report_collection = db['weekly_report']
+ingest_queue_collection = db['ingest_queue']
+classification_cache_collection = db['classification_cache']
+daily_digest_collection = db['daily_digest']
+digest_item_collection = db['daily_digest_items']
+mail_sync_collection = db['mail_sync_state']
+call_session_collection = db['call_sessions']
+
+# ---------------------------- Ingestion Queue Setup
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 4))            # Worker threads draining the queue
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", 200))  # Backlog size before webhooks are refused
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", 5))  # Attempts before a job is marked failed
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 8))      # Due jobs of one source handed to a handler together
+DEDUP_BLOOM = os.getenv("DEDUP_BLOOM", "false").lower() == "true"      # Bloom filter in front of id dedup lookups
+DEDUP_BLOOM_CAPACITY = int(os.getenv("DEDUP_BLOOM_CAPACITY", 100000))  # Expected ids per collection
 
 # ---------------------------- OpenAI Setup
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -49,6 +63,35 @@ llm = ChatOpenAI(model="gpt-4-turbo", temperature=0.5, streaming=True, api_key=O
 llm_small = ChatOpenAI(model="gpt-3.5-turbo", temperature=0.5, api_key=OPENAI_API_KEY)
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
 
+CLASSIFY_BATCH_SIZE = int(os.getenv("CLASSIFY_BATCH_SIZE", 8))      # Items packed into one classification prompt
+CLASSIFY_CONCURRENCY = int(os.getenv("CLASSIFY_CONCURRENCY", 3))    # Classification prompts in flight at once
+CLASSIFY_CACHE_SIZE = int(os.getenv("CLASSIFY_CACHE_SIZE", 1024))   # In-process cached classifications
+CLASSIFY_CACHE_TTL = int(os.getenv("CLASSIFY_CACHE_TTL", 86400))    # Seconds a cached classification stays valid
+
+# ---------------------------- Reports Setup
+EXPORT_ANALYSIS_CSV = os.getenv("EXPORT_ANALYSIS_CSV", "false").lower() == "true"  # Also write csv/ exports
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", 6000))  # Token budget per summarization call
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", 4))       # Chunk summaries in flight at once
+DIGEST_FOLD_EVERY = int(os.getenv("DIGEST_FOLD_EVERY", 20))          # Unfolded digest items that trigger a fold
+
+# ---------------------------- Voice Notes Setup
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", 4))                    # Attachments downloaded/transcribed at once
+# MEDIA_DECODE_PROCESSES (processes transcoding audio off the GIL) is read by services/audio_codec.py,
+# which forks them before this module creates the MongoDB client
+STT_BACKEND = os.getenv("STT_BACKEND", "google").lower()              # "google" (Web Speech API) or "vosk" (local CPU)
+VOSK_MODEL_PATH = os.getenv("VOSK_MODEL_PATH")                        # Unpacked Vosk model directory
+STT_THREADS = int(os.getenv("STT_THREADS", 4))                        # Voice notes recognized at once
+
+# ---------------------------- Call Sessions Setup
+CALL_SESSION_BACKEND = os.getenv("CALL_SESSION_BACKEND", "memory").lower()  # "memory" or "mongo" (shared by workers)
+CALL_SESSION_TTL = int(os.getenv("CALL_SESSION_TTL", 3600))                 # Idle seconds before a session is dropped
+CALL_HISTORY_MAX = int(os.getenv("CALL_HISTORY_MAX", 50))                   # Turns kept per call
+CALLER_CONTEXT_DAYS = int(os.getenv("CALLER_CONTEXT_DAYS", 7))              # WhatsApp history given to calls
+CALLER_CONTEXT_TOKENS = int(os.getenv("CALLER_CONTEXT_TOKENS", 2000))       # Budget for that history in prompts
+CALLER_CONTEXT_CACHE = int(os.getenv("CALLER_CONTEXT_CACHE", 256))          # Callers whose context is kept
+CALLER_CONTEXT_REFRESH = int(os.getenv("CALLER_CONTEXT_REFRESH", 30))       # Seconds before a context is re-checked
+CALLER_CONTEXT_LAG = int(os.getenv("CALLER_CONTEXT_LAG", 1800))            # Max seconds between a message's timestamp and its storage
+
 # ---------------------------- Ngrok Setup
 NGROK_URL = os.getenv("NGROK_URL")
 if not NGROK_URL:
@@ -56,6 +99,12 @@ if not NGROK_URL:
 
 # ---------------------------- Deepgram Setup
 DEEPGRAM_API = os.getenv("DEEPGRAM_API")
+TTS_VOICE = os.getenv("TTS_VOICE", "aura-luna-en")                 # Deepgram Aura voice for calls
+TTS_SAMPLE_RATE = 8000                                              # Phone audio
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")             # Rendered phrase audio (.pcm)
+TTS_CACHE_ENTRIES = int(os.getenv("TTS_CACHE_ENTRIES", 256))        # Phrases kept in memory
+TTS_DISK_ENTRIES = int(os.getenv("TTS_DISK_ENTRIES", 2000))         # Phrases kept on disk
+TTS_PRERENDER = os.getenv("TTS_PRERENDER", "false").lower() == "true"  # Render prompts/stock_phrases.txt at startup
 
 
 # ---------------------------- AMADEUS Setup
@@ -0,0 +1,83 @@
+import numpy as np
+
+from services.audio_frontend import FRAME_BYTES, SILENT_FRAME, VAD_HANGOVER, EnergyVAD, FrameStats, JitterBuffer
+
+RNG = np.random.default_rng(0)
+
+
+def _frames(level_db, count):
+    """Gaussian frames (20 ms of 8 kHz PCM) with the given RMS level in dBFS."""
+    rms = 32768 * 10 ** (level_db / 20)
+    return [np.clip(RNG.normal(0, rms, FRAME_BYTES), -32768, 32767).astype("<i2") for _ in range(count)]
+
+
+def _voiced(vad, frames):
+    return [vad.is_voiced(frame) for frame in frames]
+
+
+# ---------------------------- EnergyVAD
+def test_quiet_line_is_silent_and_speech_is_voiced():
+    vad = EnergyVAD()
+    assert not any(_voiced(vad, _frames(-70, 100)))
+    assert all(_voiced(vad, _frames(-20, 25)))
+
+
+def test_steady_noise_above_initial_floor_is_absorbed():
+    vad = EnergyVAD()
+    voiced = _voiced(vad, _frames(-40, 500))  # 10 s of a fan/car louder than VAD_MIN_DB
+    assert voiced[0]
+    assert not any(voiced[-100:])
+
+
+def test_speech_bursts_over_noise_start_and_end():
+    vad = EnergyVAD()
+    _voiced(vad, _frames(-40, 500))
+
+    for _ in range(3):
+        assert all(_voiced(vad, _frames(-15, 50)))  # 1 s of speech
+        after = _voiced(vad, _frames(-40, 100))
+        assert all(after[:VAD_HANGOVER])
+        assert not any(after[VAD_HANGOVER:])
+
+
+# ---------------------------- JitterBuffer
+def _payload(seq):
+    return bytes([seq % 256]) * FRAME_BYTES
+
+
+def _drain(buffer):
+    return [bytes(frame) for frame in buffer.pop_ready()]
+
+
+def test_reordered_frames_come_out_in_order():
+    stats = FrameStats()
+    buffer = JitterBuffer(stats)
+    out = []
+    for seq in (0, 2, 1, 3):
+        buffer.push(seq, _payload(seq))
+        out += _drain(buffer)
+
+    assert out == [_payload(seq) for seq in range(4)]
+    assert (stats.received, stats.concealed, stats.late, stats.duplicates) == (4, 0, 0, 0)
+
+
+def test_missing_frame_is_concealed_after_delay_and_late_copy_dropped():
+    stats = FrameStats()
+    buffer = JitterBuffer(stats, delay=3)
+    out = []
+    for seq in (0, 2, 3):
+        buffer.push(seq, _payload(seq))
+        out += _drain(buffer)
+    assert out == [_payload(0)]  # Still waiting for 1
+
+    buffer.push(4, _payload(4))
+    out += _drain(buffer)
+    assert out == [_payload(0), SILENT_FRAME, _payload(2), _payload(3), _payload(4)]
+    assert stats.concealed == 1
+
+    buffer.push(1, _payload(1))  # Arrives after it was concealed
+    buffer.push(4, _payload(4))
+    buffer.push(5, _payload(5))
+    buffer.push(5, _payload(5))
+    assert _drain(buffer) == [_payload(5)]
+    assert (stats.late, stats.duplicates) == (2, 1)